@@ -0,0 +1,159 @@
+"""
+Caches used by the Review Board API helpers and the services built on them.
+"""
+
+import threading
+import time
+import simplejson
+from collections import OrderedDict
+from .reviewboard import atomic_write, load_json_file
+
+
+class TTLCache(object):
+    """
+    A thread-safe LRU cache of at most @maxsize entries which expire @ttl
+    seconds after they have been set.
+
+    If @filename is given, the entries can be saved to and loaded from that
+    JSON file, so that they survive between runs. Keys and values must be
+    JSON serializable then.
+    """
+    def __init__(self, maxsize=1024, ttl=3600, filename=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.filename = filename
+        self._entries = OrderedDict() # key -> (expiration time, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return default
+            # Re-insert to mark the entry as the most recently used one.
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._trim()
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def load(self):
+        """
+        Loads the unexpired entries from the cache file (if any).
+        """
+        if not self.filename:
+            return
+        entries = load_json_file(self.filename, [])
+
+        now = time.time()
+        with self._lock:
+            for key, expires, value in entries:
+                if expires > now:
+                    self._entries[key] = (expires, value)
+            self._trim()
+
+    def save(self):
+        """
+        Saves the unexpired entries to the cache file (if any).
+        """
+        if not self.filename:
+            return
+        now = time.time()
+        with self._lock:
+            entries = [[key, expires, value]
+                       for key, (expires, value) in self._entries.iteritems()
+                       if expires > now]
+        try:
+            atomic_write(self.filename, simplejson.dumps(entries))
+        except (IOError, OSError), e:
+            print("Couldn't save cache %s: %s" % (self.filename, e))
+
+    def _trim(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class ResponseCache(object):
+    """
+    Bodies of GET responses together with their validators (ETag and
+    Last-Modified), so that HttpClient can make conditional requests and
+    serve '304 Not Modified' answers from the cache.
+
+    The least recently used responses are evicted to keep the total size of
+    the bodies under @maxbytes. If @filename is given, the responses can be
+    saved to and loaded from that JSON file.
+    """
+    def __init__(self, maxbytes=64 * 1024 * 1024, filename=None):
+        self.maxbytes = maxbytes
+        self.filename = filename
+        self._entries = OrderedDict() # url -> (etag, last modified, body)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url):
+        """
+        Returns the (etag, last modified, body) tuple cached for @url or None.
+        """
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._entries[url] = entry
+            return entry
+
+    def set(self, url, etag, last_modified, body):
+        if not etag and not last_modified:
+            # The response can't be revalidated, no point in keeping it.
+            return
+        with self._lock:
+            self._remove(url)
+            if len(body) > self.maxbytes:
+                return
+            self._entries[url] = (etag, last_modified, body)
+            self._size += len(body)
+            while self._size > self.maxbytes:
+                self._remove(iter(self._entries).next())
+
+    def delete(self, url):
+        with self._lock:
+            self._remove(url)
+
+    def load(self):
+        if not self.filename:
+            return
+        entries = load_json_file(self.filename, [])
+        for url, etag, last_modified, body in entries:
+            self.set(url, etag, last_modified, body.encode('utf-8'))
+
+    def save(self):
+        if not self.filename:
+            return
+        with self._lock:
+            entries = [[url, etag, last_modified, body.decode('utf-8')]
+                       for url, (etag, last_modified, body)
+                       in self._entries.iteritems()]
+        try:
+            atomic_write(self.filename, simplejson.dumps(entries))
+        except (IOError, OSError), e:
+            print("Couldn't save cache %s: %s" % (self.filename, e))
+
+    def _remove(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._size -= len(entry[2])
@@ -2,26 +2,61 @@
 Extensions and utility functions for Python Review Board API.
 """
 
+import threading
 import urllib
+from multiprocessing.pool import ThreadPool
 from .reviewboard import Api20Client, make_rbclient
 
+RB_SERVER = "https://review.salsitasoft.com/"
 
-def get_review_requests2(options, auth):
-    rb_api = make_rbclient("https://review.salsitasoft.com/", auth['username'], auth['password'])
+# Process-wide clients keyed by (server, username).
+_rbclients = {}
+_rbclients_lock = threading.Lock()
+
+
+def get_rbclient(auth, server=RB_SERVER, **kwargs):
+    """
+    Returns the shared API client for @server and the user in @auth.
+
+    Building a client loads the cookie file, sets up the URL opener and
+    probes the server for its API version, so it is done only once per
+    (server, username) and the client is reused afterwards. @kwargs are
+    passed to make_rbclient() when the client is created.
+    """
+    key = (server, auth['username'])
+    with _rbclients_lock:
+        rb_api = _rbclients.get(key)
+        if rb_api is None:
+            rb_api = make_rbclient(server, auth['username'], auth['password'],
+                                   **kwargs)
+            _rbclients[key] = rb_api
+        return rb_api
+
+
+def reset_rbclients():
+    """
+    Closes and drops all the shared clients (they will be recreated on next
+    use).
+    """
+    with _rbclients_lock:
+        for rb_api in _rbclients.values():
+            rb_api.close()
+        _rbclients.clear()
+
+
+def get_review_requests2(rb_api, options):
     review_reqs = rb_api.get_review_requests(options)
     return review_reqs
 
-def get_user_data(auth, url):
-    rb_api = make_rbclient("https://review.salsitasoft.com/", auth['username'], auth['password'])
+def get_user_data(rb_api, url):
     res = rb_api._api_request('GET', url)
-    if res['stat'] != 'ok':                                                                              
-         print 'ERROR when getting user: ' + res
+    if res['stat'] != 'ok':
+         print 'ERROR when getting user: %s' % (res,)
          return None
-    return res['user']    
+    return res['user']
 
 
-def get_last_update_info(auth, rid):
-    rb_api = make_rbclient("https://review.salsitasoft.com/", auth['username'], auth['password'])
+def get_last_update_info(rb_api, rid):
     res = rb_api._api_request(
             'GET',
             '/api/review-requests/%s/last-update/' % (rid,))
@@ -33,7 +68,7 @@ def get_last_update_info(auth, rid):
 def is_story_approved(rb_server_url, story_id, auth=None):
     if not auth:
         auth = {'username': '', 'password': ''}
-    rb_api = make_rbclient(rb_server_url, auth['username'], auth['password'])
+    rb_api = get_rbclient(auth, rb_server_url)
 
     review_reqs = rb_api.get_review_requests()
     reviews_for_branch = [r for r in review_reqs
@@ -53,8 +88,7 @@ def is_story_approved(rb_server_url, story_id, auth=None):
         all(is_shipited(r) for r in reviews_for_branch))
 
 
-def get_reviews_for_review_request(auth, rev_req_id):
-    rb_api = make_rbclient("https://review.salsitasoft.com/", auth['username'], auth['password'])
+def get_reviews_for_review_request(rb_api, rev_req_id):
     rsp = rb_api._api_request(
         'GET', '/api/review-requests/%s/reviews/?max-results=200' % rev_req_id)
     return rsp['reviews']
@@ -62,19 +96,78 @@ def get_reviews_for_review_request(auth, rev_req_id):
 Api20Client.get_reviews_for_review_request = get_reviews_for_review_request
 
 
-def get_review_requests(self, options=None):
-    options = options or {}
-    rsp = self._api_request(
-        'GET', '/api/review-requests/?%s' % urllib.urlencode(options))
+def _review_requests_url(options, start=None):
+    options = dict(options or {})
+    if start:
+        options['start'] = start
+    return '/api/review-requests/?%s' % urllib.urlencode(options)
+
+
+def iter_review_requests(self, options=None, parallelism=1):
+    """
+    Yields the review requests matching @options as the pages arrive,
+    following the 'next' link of each page. Only one page is held in
+    memory at a time.
+
+    With @parallelism > 1, the first page tells how many review requests
+    there are, and the remaining pages are then fetched by that many
+    threads at once. They are still yielded in order.
+    """
+    url = _review_requests_url(options)
+    rsp = self._api_request('GET', url)
     if rsp['stat'] != 'ok':
         print 'ERROR: ' + rsp['stat']
-        return []
-    start = options.get('start', 0)
-    result = rsp['review_requests']
-    if (rsp['total_results'] > start):
-        print 'requesting another chunk, start at %s, total %s' % (start + 200, rsp['total_results'])
-        options.update({'max-results': 200, 'start': start + 200})
-        result = result + self.get_review_requests(options)
-    return result
+        return
+
+    first_page = rsp['review_requests']
+    if parallelism > 1 and first_page:
+        for review_request in first_page:
+            yield review_request
+        for review_request in _iter_remaining_pages(
+                self, options, rsp['total_results'], len(first_page),
+                parallelism):
+            yield review_request
+        return
+
+    while True:
+        for review_request in rsp['review_requests']:
+            yield review_request
+        url = rsp.get('links', {}).get('next', {}).get('href')
+        if not url:
+            return
+        rsp = self._api_request('GET', url)
+        if rsp['stat'] != 'ok':
+            print 'ERROR: ' + rsp['stat']
+            return
+
+
+def _iter_remaining_pages(rb_api, options, total_results, page_size,
+                          parallelism):
+    start = int((options or {}).get('start', 0))
+
+    def fetch_page(page_start):
+        rsp = rb_api._api_request(
+            'GET', _review_requests_url(options, page_start))
+        if rsp['stat'] != 'ok':
+            print 'ERROR: ' + rsp['stat']
+            return []
+        return rsp['review_requests']
+
+    # The server may cap max-results, so step by the size of the page it
+    # actually returned.
+    starts = range(start + page_size, total_results, page_size)
+    pool = ThreadPool(min(parallelism, len(starts)) or 1)
+    try:
+        for page in pool.imap(fetch_page, starts):
+            for review_request in page:
+                yield review_request
+    finally:
+        pool.terminate()
+
+Api20Client.iter_review_requests = iter_review_requests
+
+
+def get_review_requests(self, options=None, parallelism=1):
+    return list(self.iter_review_requests(options, parallelism))
 
 Api20Client.get_review_requests = get_review_requests
@@ -0,0 +1,204 @@
+# Persistent (keep-alive) HTTP connections for urllib2.
+#
+# urllib2's own handlers open a new connection (and do a new TLS handshake)
+# for every request. These handlers take the connection from a pool instead
+# and put it back once the response body has been read. The body is read
+# straight from the connection, as the caller reads it.
+
+import httplib
+import select
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+POOL_SIZE = 4
+IDLE_TIMEOUT = 60
+# Requests which can be sent again if the server may have got them already.
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+# A body closed before it has been read is drained (to reuse the connection)
+# if there's at most this much of it left.
+MAX_DRAIN = 64 * 1024
+
+class ConnectionPool:
+    """
+    Idle connections, at most @max_per_host per host. Connections which
+    have been idle for more than @idle_timeout seconds are dropped.
+    """
+    def __init__(self, max_per_host=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {} # key -> [(connection, time it was put back)]
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns an idle connection for @key or None if there's none.
+        """
+        now = time.time()
+        with self._lock:
+            conns = self._idle.get(key, [])
+            while conns:
+                conn, last_used = conns.pop()
+                if (now - last_used <= self.idle_timeout and
+                        not _is_closed(conn)):
+                    return conn
+                conn.close()
+        return None
+
+    def put(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_per_host:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn, last_used in conns:
+                    conn.close()
+            self._idle.clear()
+
+class KeepAliveMixin:
+    def _keepalive_open(self, conn_class, req, **conn_args):
+        if getattr(req, '_tunnel_host', None):
+            # HTTPS through a proxy needs a CONNECT tunnel, leave it to urllib2.
+            return self.do_open(conn_class, req, **conn_args)
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (conn_class, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        headers['Connection'] = 'keep-alive'
+
+        conn = self.pool.get(key)
+        try:
+            if conn is not None:
+                try:
+                    self._send(conn, req, headers)
+                except (socket.error, httplib.HTTPException):
+                    # The server has closed the idle connection. It hasn't
+                    # got the whole request, so send it on a new one.
+                    conn.close()
+                    conn = None
+                else:
+                    try:
+                        return self._receive(key, conn, req)
+                    except (socket.error, httplib.HTTPException):
+                        # The server may have closed the idle connection, or
+                        # failed after it got the request. Only send it
+                        # again if doing it twice does no harm.
+                        conn.close()
+                        if req.get_method() not in IDEMPOTENT_METHODS:
+                            raise
+                        conn = None
+            conn = conn_class(host, timeout=req.timeout, **conn_args)
+            self._send(conn, req, headers)
+            return self._receive(key, conn, req)
+        except socket.error, err:
+            if conn is not None:
+                conn.close()
+            raise urllib2.URLError(err)
+
+    def _send(self, conn, req, headers):
+        data = req.get_data()
+        if hasattr(data, 'seek'):
+            # Rewind the body if it has been partly sent on a stale connection.
+            data.seek(0)
+        conn.request(req.get_method(), req.get_selector(), data, headers)
+
+    def _receive(self, key, conn, req):
+        rsp = conn.getresponse()
+
+        def release(reusable):
+            if reusable:
+                self.pool.put(key, conn)
+            else:
+                conn.close()
+
+        result = urllib.addinfourl(ResponseBody(rsp, release), rsp.msg,
+                                   req.get_full_url())
+        result.code = rsp.status
+        result.msg = rsp.reason
+        return result
+
+class ResponseBody:
+    """
+    The body of the httplib response @rsp, read from its connection as it's
+    read from here. Once it has been read to its end or closed, @release is
+    called with whether the connection can be reused.
+    """
+    def __init__(self, rsp, release):
+        self._rsp = rsp
+        self._release = release
+
+    def read(self, amt=None):
+        if self._rsp is None:
+            return ''
+        data = self._rsp.read(amt)
+        if self._rsp.isclosed():
+            self._done()
+        return data
+
+    def readline(self):
+        chunks = []
+        while True:
+            chunk = self.read(1)
+            chunks.append(chunk)
+            if not chunk or chunk == '\n':
+                return ''.join(chunks)
+
+    def close(self):
+        rsp = self._rsp
+        if rsp is None:
+            return
+        if rsp.length is not None and rsp.length <= MAX_DRAIN:
+            try:
+                rsp.read()
+            except (socket.error, httplib.HTTPException):
+                pass
+        self._done()
+
+    def _done(self):
+        rsp = self._rsp
+        self._rsp = None
+        self._release(rsp.isclosed() and not rsp.will_close)
+
+def _is_closed(conn):
+    """
+    Returns True if the server has closed the idle connection @conn. An idle
+    connection has nothing to read unless it's at its end.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+class KeepAliveHTTPHandler(KeepAliveMixin, urllib2.HTTPHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool or ConnectionPool()
+
+    def http_open(self, req):
+        return self._keepalive_open(httplib.HTTPConnection, req)
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, urllib2.HTTPSHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
+        self.pool = pool or ConnectionPool()
+
+    def https_open(self, req):
+        conn_args = {}
+        if getattr(self, '_context', None) is not None:
+            conn_args['context'] = self._context
+        return self._keepalive_open(httplib.HTTPSConnection, req, **conn_args)
@@ -0,0 +1,125 @@
+# Streaming multipart/form-data request bodies.
+#
+# The body is produced chunk by chunk while httplib sends it, so large diffs
+# are never copied into one big string. Its length is known up front.
+
+import mimetools
+import os
+
+class MultipartBody:
+    """
+    A multipart/form-data body made of the @fields dict and the @files dict.
+    Each file is a dict with a 'filename' and one of:
+
+      'content' ... the file data as a string,
+      'file'    ... a file-like object (an open file, a mmap, ...) read from
+                    its current position to its end,
+      'path'    ... the path of a file to read.
+
+    It has the file-like interface httplib needs to send it (read()) plus
+    seek(0) to send it again and close() to close the files it opened.
+    """
+    def __init__(self, fields=None, files=None, boundary=None):
+        self.boundary = boundary or mimetools.choose_boundary()
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+        self._parts = [] # strings and (file, start, size) tuples
+        self._opened = []
+
+        fields = fields or {}
+        files = files or {}
+
+        for key in fields:
+            self._parts.append(
+                "--" + self.boundary + "\r\n" +
+                "Content-Disposition: form-data; name=\"%s\"\r\n" % key +
+                "\r\n" +
+                str(fields[key]) + "\r\n")
+
+        for key in files:
+            spec = files[key]
+            self._parts.append(
+                "--" + self.boundary + "\r\n" +
+                "Content-Disposition: form-data; name=\"%s\"; " % key +
+                "filename=\"%s\"\r\n" % spec['filename'] +
+                "\r\n")
+            if 'content' in spec:
+                self._parts.append(spec['content'])
+            else:
+                if 'path' in spec:
+                    f = open(spec['path'], 'rb')
+                    self._opened.append(f)
+                else:
+                    f = spec['file']
+                self._parts.append(_file_part(f))
+            self._parts.append("\r\n")
+
+        self._parts.append("--" + self.boundary + "--\r\n" + "\r\n")
+
+        self.length = 0
+        for part in self._parts:
+            if isinstance(part, tuple):
+                self.length += part[2]
+            else:
+                self.length += len(part)
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError("MultipartBody can only be rewound")
+        self._index = 0
+        self._offset = 0
+
+    def read(self, size=-1):
+        chunks = []
+        while self._index < len(self._parts) and size != 0:
+            part = self._parts[self._index]
+            if isinstance(part, tuple):
+                f, start, part_size = part
+                if self._offset == 0:
+                    f.seek(start)
+                left = part_size - self._offset
+                chunk = f.read(left if size < 0 else min(size, left))
+                if not chunk and left:
+                    raise IOError("File changed while being uploaded")
+            else:
+                end = len(part) if size < 0 else self._offset + size
+                chunk = part[self._offset:end]
+                part_size = len(part)
+
+            chunks.append(chunk)
+            self._offset += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+            if self._offset >= part_size:
+                self._index += 1
+                self._offset = 0
+        return ''.join(chunks)
+
+    def getvalue(self):
+        """
+        Returns the whole body as a string.
+        """
+        self.seek(0)
+        value = self.read()
+        self.seek(0)
+        return value
+
+    def close(self):
+        for f in self._opened:
+            f.close()
+        self._opened = []
+
+def _file_part(f):
+    start = f.tell()
+    if hasattr(f, 'fileno'):
+        try:
+            return f, start, os.fstat(f.fileno()).st_size - start
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+    f.seek(0, 2)
+    size = f.tell() - start
+    f.seek(start)
+    return f, start, size
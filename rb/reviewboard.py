@@ -1,14 +1,81 @@
 # api code for the reviewboard extension, inspired/copied from reviewboard
 # post-review code.
 
+import base64
 import cookielib
 import getpass
-import mimetools
+import hashlib
+import httplib
 import os
+import sys
+import threading
+import time
+import urllib
 import urllib2
+import zlib
 import simplejson
+
+from cStringIO import StringIO
 #import mercurial.ui
 from urlparse import urljoin, urlparse
+from keepalive import (ConnectionPool, KeepAliveHTTPHandler,
+                       KeepAliveHTTPSHandler)
+from multipart import MultipartBody
+
+# How long (in seconds) a detected server API version is trusted.
+API_CACHE_TTL = 24 * 60 * 60
+
+# Size of the chunks in which response bodies are read and decompressed.
+READ_CHUNK_SIZE = 64 * 1024
+
+def get_home_path():
+    """
+    Returns the directory where per-user files (cookies, caches) are kept.
+    """
+    if 'APPDATA' in os.environ:
+        return os.environ["APPDATA"]
+    elif 'USERPROFILE' in os.environ:
+        return os.path.join(os.environ["USERPROFILE"], "Local Settings",
+                            "Application Data")
+    elif 'HOME' in os.environ:
+        return os.environ["HOME"]
+    else:
+        return ''
+
+def atomic_write(filename, data):
+    """
+    Writes @data to @filename so that readers never see a partial file.
+    """
+    tmp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    f = open(tmp_filename, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    replace_file(tmp_filename, filename)
+
+def load_json_file(filename, default=None):
+    """
+    Returns the data in the JSON file @filename, or @default if the file
+    can't be read or isn't valid JSON.
+    """
+    try:
+        f = open(filename)
+        try:
+            return simplejson.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return default
+
+def replace_file(src, dst):
+    """
+    Renames @src to @dst, replacing @dst if it exists.
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        # Windows can't rename over an existing file.
+        os.remove(dst)
+    os.rename(src, dst)
 
 class APIError(Exception):
     pass
@@ -68,6 +135,8 @@ class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
         self.rb_url  = reviewboard_url
         self.rb_user = None
         self.rb_pass = None
+        # Whether to prompt for the credentials we don't have.
+        self.interactive = True
 
     def set_credentials(self, username, password):
         self.rb_user = username
@@ -75,7 +144,8 @@ class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
 
     def find_user_password(self, realm, uri):
         if uri.startswith(self.rb_url):
-            if self.rb_user is None or self.rb_pass is None:
+            if ((self.rb_user is None or self.rb_pass is None) and
+                    self.interactive):
                 print "==> HTTP Authentication Required"
                 print 'Enter username and password for "%s" at %s' % \
                     (realm, urlparse(uri)[1])
@@ -114,27 +184,157 @@ class HttpErrorHandler(urllib2.HTTPDefaultErrorHandler):
             result.status = code
             return result
 
+class TrackingCookieJar(cookielib.MozillaCookieJar):
+    """
+    Cookie jar which knows whether its cookies have changed since it was
+    last loaded or saved, and which saves the cookie file atomically.
+    """
+    def __init__(self, filename=None):
+        cookielib.MozillaCookieJar.__init__(self, filename)
+        self.dirty = False
+
+    def set_cookie(self, cookie):
+        self._cookies_lock.acquire()
+        try:
+            old = self._cookies.get(cookie.domain, {}).get(
+                cookie.path, {}).get(cookie.name)
+            if (old is None or old.value != cookie.value or
+                    old.expires != cookie.expires):
+                self.dirty = True
+            cookielib.MozillaCookieJar.set_cookie(self, cookie)
+        finally:
+            self._cookies_lock.release()
+
+    def clear(self, domain=None, path=None, name=None):
+        cookielib.MozillaCookieJar.clear(self, domain, path, name)
+        self.dirty = True
+
+    def load(self, filename=None, ignore_discard=False, ignore_expires=False):
+        cookielib.MozillaCookieJar.load(self, filename, ignore_discard,
+                                        ignore_expires)
+        self.dirty = False
+
+    def save(self, filename=None, ignore_discard=False, ignore_expires=False):
+        filename = filename or self.filename
+        tmp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        cookielib.MozillaCookieJar.save(self, tmp_filename, ignore_discard,
+                                        ignore_expires)
+        replace_file(tmp_filename, filename)
+        self.dirty = False
+
+class ApiVersionCache:
+    """
+    Remembers the API version and the root resource URI templates of Review
+    Board servers in a JSON file, so that building a client doesn't need
+    a round trip to the server. Entries expire after @ttl seconds.
+    """
+    def __init__(self, filename=None, ttl=API_CACHE_TTL):
+        if not filename:
+            filename = os.path.join(get_home_path(),
+                                    ".post-review-apicache.json")
+        self.filename = filename
+        self.ttl = ttl
+
+    def get(self, url):
+        entry = self._load().get(url)
+        if not entry or time.time() - entry.get('timestamp', 0) > self.ttl:
+            return None
+        return entry
+
+    def set(self, url, apiver, uri_templates=None):
+        entries = self._load()
+        entries[url] = {
+            'apiver': apiver,
+            'uri_templates': uri_templates or {},
+            'timestamp': time.time(),
+        }
+        self._save(entries)
+
+    def invalidate(self, url):
+        entries = self._load()
+        if entries.pop(url, None) is not None:
+            self._save(entries)
+
+    def _load(self):
+        return load_json_file(self.filename, {})
+
+    def _save(self, entries):
+        try:
+            atomic_write(self.filename, simplejson.dumps(entries))
+        except (IOError, OSError), e:
+            print("Couldn't save API version cache: %s" % e)
+
+class DiffDigestIndex:
+    """
+    Remembers the digests of the diff, parent diff and fields last uploaded
+    for each review request (per server) in a JSON file, so that unchanged
+    ones needn't be uploaded again.
+    """
+    def __init__(self, filename=None):
+        if not filename:
+            filename = os.path.join(get_home_path(),
+                                    ".post-review-diffdigests.json")
+        self.filename = filename
+
+    def get(self, url, id):
+        return self._load().get(url, {}).get(str(id), {})
+
+    def set(self, url, id, digests):
+        entries = self._load()
+        entries.setdefault(url, {})[str(id)] = digests
+        try:
+            atomic_write(self.filename, simplejson.dumps(entries))
+        except (IOError, OSError), e:
+            print("Couldn't save diff digests: %s" % e)
+
+    def _load(self):
+        return load_json_file(self.filename, {})
+
+def content_digest(data):
+    """
+    Returns the SHA-1 hex digest of @data, a string or a file-like object.
+    A file is read from its current position, which is restored afterwards.
+    """
+    sha1 = hashlib.sha1()
+    if hasattr(data, 'read'):
+        start = data.tell()
+        while True:
+            chunk = data.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+        data.seek(start)
+    else:
+        sha1.update(data)
+    return sha1.hexdigest()
+
+def fields_digest(fields):
+    return content_digest(simplejson.dumps(fields, sort_keys=True))
+
 class HttpClient:
-    def __init__(self, url, proxy=None):
+    def __init__(self, url, proxy=None, response_cache=None,
+                 connection_pool=None, preemptive_auth=False):
         if not url.endswith('/'):
             url = url + '/'
         self.url       = url
-        if 'APPDATA' in os.environ:
-            homepath = os.environ["APPDATA"]
-        elif 'USERPROFILE' in os.environ:
-            homepath = os.path.join(os.environ["USERPROFILE"], "Local Settings",
-                                    "Application Data")
-        elif 'HOME' in os.environ:
-            homepath = os.environ["HOME"]
-        else:
-            homepath = ''
-        self.cookie_file = os.path.join(homepath, ".post-review-cookies.txt")
-        self._cj = cookielib.MozillaCookieJar(self.cookie_file)
+        # Send the credentials with the requests instead of waiting for
+        # a 401 challenge (until the server gives us a session cookie).
+        self.preemptive_auth = preemptive_auth
+        self._auth_header = None
+        # Optional rb.cache.ResponseCache for conditional GETs.
+        self.response_cache = response_cache
+        # Keep-alive connections to the server, reused across requests.
+        self.connection_pool = connection_pool or ConnectionPool()
+        self.cookie_file = os.path.join(get_home_path(),
+                                        ".post-review-cookies.txt")
+        self._cj = TrackingCookieJar(self.cookie_file)
+        self._cj_lock = threading.Lock()
         self._password_mgr = ReviewBoardHTTPPasswordMgr(self.url)
         self._opener = opener = urllib2.build_opener(
                         urllib2.ProxyHandler(proxy),
                         urllib2.UnknownHandler(),
-                        urllib2.HTTPHandler(),
+                        KeepAliveHTTPHandler(self.connection_pool),
+                        KeepAliveHTTPSHandler(self.connection_pool),
                         HttpErrorHandler(),
                         urllib2.HTTPErrorProcessor(),
                         urllib2.HTTPCookieProcessor(self._cj),
@@ -145,6 +345,35 @@ class HttpClient:
 
     def set_credentials(self, username, password):
         self._password_mgr.set_credentials(username, password)
+        if self.preemptive_auth and username and password:
+            self._auth_header = 'Basic ' + base64.b64encode(
+                '%s:%s' % (username, password))
+
+    def set_api_token(self, token):
+        """
+        Authenticates the requests with a Review Board API token. The token
+        is sent unless there's a session cookie, and nobody is ever prompted
+        for a password.
+        """
+        self._auth_header = 'token %s' % token
+        self._password_mgr.interactive = False
+
+    def close(self):
+        """
+        Saves the cookies (if they have changed) and closes the idle
+        keep-alive connections.
+        """
+        self.save_cookies()
+        self.connection_pool.close_all()
+
+    def save_cookies(self):
+        """
+        Rewrites the cookie file if the cookies have changed since it was
+        loaded or saved.
+        """
+        with self._cj_lock:
+            if self._cj.dirty:
+                self._cj.save(self.cookie_file)
 
     def api_request(self, method, url, fields=None, files=None):
         """
@@ -179,21 +408,42 @@ class HttpClient:
                   (host, path, self.cookie_file))
             self._cj.load(self.cookie_file, ignore_expires=True)
 
-            try:
-                cookie = self._cj._cookies[host][path]['rbsessionid']
-
-                if not cookie.is_expired():
-                    print("Loaded valid cookie -- no login required")
-                    return True
-
-                print("Cookie file loaded, but cookie has expired")
-            except KeyError:
+            cookie = self._session_cookie()
+            if cookie is None:
                 print("Cookie file loaded, but no cookie for this server")
+            elif not cookie.is_expired():
+                print("Loaded valid cookie -- no login required")
+                return True
+            else:
+                print("Cookie file loaded, but cookie has expired")
         except IOError, error:
             print("Couldn't load cookie file: %s" % error)
 
         return False
 
+    def _session_cookie(self):
+        """
+        Returns the 'rbsessionid' cookie for the server or None.
+        """
+        host, path = self._cookie_location()
+        try:
+            return self._cj._cookies[host][path]['rbsessionid']
+        except KeyError:
+            return None
+
+    def _drop_session_cookie(self):
+        host, path = self._cookie_location()
+        with self._cj_lock:
+            try:
+                self._cj.clear(host, path, 'rbsessionid')
+            except KeyError:
+                pass
+
+    def _cookie_location(self):
+        parsed_url = urlparse(self.url)
+        # Cookie files don't store port numbers.
+        return parsed_url[1].split(":")[0], parsed_url[2] or '/'
+
     def _http_request(self, method, path, fields, files):
         """
         Performs an HTTP request on the specified path.
@@ -202,30 +452,123 @@ class HttpClient:
             path = path[1:]
         url = urljoin(self.url, path)
         body = None
-        headers = {}
+        headers = {'Accept-Encoding': 'gzip, deflate'}
         if fields or files:
             content_type, body = self._encode_multipart_formdata(fields, files)
-            headers = {
+            headers.update({
                 'Content-Type': content_type,
                 'Content-Length': str(len(body))
-                }
-
+                })
+
+        if type(url) == unicode:
+            url = url.encode('utf8')
+
+        if self._auth_header:
+            cookie = self._session_cookie()
+            if cookie is None or cookie.is_expired():
+                headers['Authorization'] = self._auth_header
+
+        cached = None
+        if method == 'GET' and self.response_cache is not None:
+            cached = self.response_cache.get(url)
+            if cached:
+                etag, last_modified = cached[:2]
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+
+        rsp = None
         try:
-            if type(url) == unicode:
-                url = url.encode('utf8')
-            r = ApiRequest(method, url, body, headers)
-            data = urllib2.urlopen(r).read()
-            self._cj.save(self.cookie_file)
+            rsp = self._open(method, url, body, headers)
+            if cached and getattr(rsp, 'code', None) == 304:
+                data = cached[2]
+            else:
+                data = self._read_body(rsp)
+                if method == 'GET' and self.response_cache is not None:
+                    info = rsp.info()
+                    self.response_cache.set(url, info.getheader('ETag'),
+                                            info.getheader('Last-Modified'),
+                                            data)
+            self.save_cookies()
             return data
         except urllib2.URLError, e:
             if not hasattr(e, 'code'):
                 raise
             if e.code >= 400:
+                self._buffer_error_body(e)
                 raise
             else:
                 return ""
         except urllib2.HTTPError, e:
             raise ReviewBoardError(e.read())
+        finally:
+            if rsp is not None:
+                # Gives the connection back to the pool.
+                rsp.close()
+            if body is not None:
+                body.close()
+
+    def _open(self, method, url, body, headers):
+        """
+        Opens the request. If the server doesn't accept the session cookie
+        anymore (a 401 to a request without an Authorization header), the
+        cookie is dropped and the request is sent once more with the
+        preemptive credentials.
+        """
+        try:
+            return self._opener.open(ApiRequest(method, url, body, headers))
+        except urllib2.HTTPError, e:
+            if (e.code != 401 or not self._auth_header or
+                    'Authorization' in headers):
+                raise
+            e.close()
+        print "Session expired, authenticating again"
+        self._drop_session_cookie()
+        if body is not None:
+            body.seek(0)
+        headers = dict(headers, Authorization=self._auth_header)
+        return self._opener.open(ApiRequest(method, url, body, headers))
+
+    def _buffer_error_body(self, e):
+        """
+        Reads the body of the HTTPError @e from the connection, decompressing
+        it like any other, and keeps it as e.body. e.read() then reads it
+        from memory.
+        """
+        data = ''
+        if getattr(e, 'fp', None) is not None:
+            try:
+                data = self._read_body(e)
+            except (IOError, httplib.HTTPException, zlib.error):
+                pass
+            e.close()
+        headers = e.info()
+        if headers is not None and 'content-encoding' in headers:
+            del headers['content-encoding']
+        e.body = data
+        urllib.addinfourl.__init__(e, StringIO(data), headers, e.geturl(),
+                                   e.code)
+
+    def _read_body(self, rsp):
+        """
+        Reads the body of @rsp, decompressing it chunk by chunk as it's read
+        if the server sent it gzip or deflate encoded.
+        """
+        encoding = (rsp.info().getheader('Content-Encoding') or '').lower()
+        if encoding not in ('gzip', 'deflate'):
+            return rsp.read()
+
+        # Accept both the gzip and the zlib header.
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        chunks = []
+        while True:
+            chunk = rsp.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(decompressor.decompress(chunk))
+        chunks.append(decompressor.flush())
+        return ''.join(chunks)
 
     def _process_json(self, data):
         """
@@ -241,50 +584,58 @@ class HttpClient:
 
     def _encode_multipart_formdata(self, fields, files):
         """
-        Encodes data for use in an HTTP POST.
+        Encodes data for use in an HTTP POST. The body is a streaming
+        MultipartBody, so files are read as they are sent.
         """
-        BOUNDARY = mimetools.choose_boundary()
-        content = ""
-
-        fields = fields or {}
-        files = files or {}
-
-        for key in fields:
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"\r\n" % key
-            content += "\r\n"
-            content += str(fields[key]) + "\r\n"
-
-        for key in files:
-            filename = files[key]['filename']
-            value = files[key]['content']
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"; " % key
-            content += "filename=\"%s\"\r\n" % filename
-            content += "\r\n"
-            content += value + "\r\n"
-
-        content += "--" + BOUNDARY + "--\r\n"
-        content += "\r\n"
-
-        content_type = "multipart/form-data; boundary=%s" % BOUNDARY
+        body = MultipartBody(fields, files)
+        return body.content_type, body
 
-        return content_type, content
+def diff_file(filename, diff):
+    """
+    Returns the upload spec for @diff, which is either the diff itself or
+    a file-like object (e.g. an open file or a mmap) to read it from.
+    """
+    if hasattr(diff, 'read'):
+        return {'filename': filename, 'file': diff}
+    return {'filename': filename, 'content': diff}
 
 class ApiClient:
-    def __init__(self, httpclient):
+    def __init__(self, httpclient, apicache=None):
         self._httpclient = httpclient
+        self._apicache = apicache
+
+    def close(self):
+        self._httpclient.close()
 
     def _api_request(self, method, url, fields=None, files=None):
-        return self._httpclient.api_request(method, url, fields, files)
+        try:
+            return self._httpclient.api_request(method, url, fields, files)
+        except urllib2.HTTPError, e:
+            et, ei, tb = sys.exc_info()
+            if e.code == 404 and self._apicache is not None:
+                # Review Board answers unknown API objects with a JSON error.
+                # A non-JSON 404 means the server doesn't speak the API
+                # version we have cached for it, so let the next client
+                # probe it again.
+                if not hasattr(e, 'body'):
+                    e.body = e.read()
+                try:
+                    simplejson.loads(e.body)
+                except ValueError:
+                    self._apicache.invalidate(self._httpclient.url)
+            # A bare raise would raise the ValueError caught above.
+            raise et, ei, tb
 
 class Api20Client(ApiClient):
     """
     Implements the 2.0 version of the API
     """
 
-    def __init__(self, httpclient):
-        ApiClient.__init__(self, httpclient)
+    def __init__(self, httpclient, apicache=None, uri_templates=None,
+                 diffindex=None):
+        ApiClient.__init__(self, httpclient, apicache)
+        self.uri_templates = uri_templates or {}
+        self._diffindex = diffindex
         self._repositories = None
         self._requestcache = {}
 
@@ -302,20 +653,48 @@ class Api20Client(ApiClient):
 
     def new_request(self, repo_id, fields={}, diff='', parentdiff=''):
         req = self._create_request(repo_id)
+        digests = self._digests(fields, diff, parentdiff)
         self._set_request_details(req, fields, diff, parentdiff)
         self._requestcache[req['id']] = req
+        if digests:
+            digests['published'] = False
+            self._diffindex.set(self._httpclient.url, req['id'], digests)
         return req['id']
 
     def update_request(self, id, fields={}, diff='', parentdiff='', publish=True):
         req = self._get_request(id)
+        digests = self._digests(fields, diff, parentdiff)
+        old_digests = {}
+        if digests:
+            # Skip uploading what's the same as the last time.
+            old_digests = self._diffindex.get(self._httpclient.url, id)
+            if (diff and digests['diff'] == old_digests.get('diff') and
+                    digests['parentdiff'] == old_digests.get('parentdiff')):
+                print ("Diff for review request %s hasn't changed, "
+                       "not uploading it" % id)
+                diff = parentdiff = ''
+            if fields and digests['fields'] == old_digests.get('fields'):
+                fields = {}
+
         self._set_request_details(req, fields, diff, parentdiff)
-        if publish:
+        if digests and (fields or diff):
+            # The uploads stay a draft until publish() succeeds.
+            old_digests.update(digests, published=False)
+            self._diffindex.set(self._httpclient.url, id, old_digests)
+        # If nothing has been uploaded, there's only a draft to publish if
+        # the last uploads haven't been published.
+        if publish and (fields or diff or not old_digests.get('published')):
             self.publish(id)
 
     def publish(self, id):
         req = self._get_request(id)
         drafturl = req['links']['draft']['href']
         self._api_request('PUT', drafturl, {'public':'1'})
+        if self._diffindex is not None:
+            digests = self._diffindex.get(self._httpclient.url, id)
+            if digests:
+                digests['published'] = True
+                self._diffindex.set(self._httpclient.url, id, digests)
 
     def _create_request(self, repo_id):
         data = { 'repository': repo_id }
@@ -330,6 +709,21 @@ class Api20Client(ApiClient):
             self._requestcache[id] = result['review_request']
             return result['review_request']
 
+    def _digests(self, fields, diff, parentdiff):
+        """
+        Returns the digests of what is to be uploaded (nothing if there's
+        no diff index).
+        """
+        digests = {}
+        if self._diffindex is None:
+            return digests
+        if fields:
+            digests['fields'] = fields_digest(fields)
+        if diff:
+            digests['diff'] = content_digest(diff)
+            digests['parentdiff'] = content_digest(parentdiff)
+        return digests
+
     def _set_request_details(self, req, fields, diff, parentdiff):
         drafturl = req['links']['self']['href']
         if fields:
@@ -341,10 +735,9 @@ class Api20Client(ApiClient):
             self._api_request('PUT', drafturl, fields)
         if diff:
             diffurl = req['links']['diffs']['href']
-            data = {'path': {'filename': 'diff', 'content': diff}}
+            data = {'path': diff_file('diff', diff)}
             if parentdiff:
-                data['parent_diff_path'] = \
-                    {'filename': 'parent_diff', 'content': parentdiff}
+                data['parent_diff_path'] = diff_file('parent_diff', parentdiff)
             self._api_request('POST', diffurl, {}, data)
 
 class Api10Client(ApiClient):
@@ -352,8 +745,8 @@ class Api10Client(ApiClient):
     Implements the 1.0 version of the API
     """
 
-    def __init__(self, httpclient):
-        ApiClient.__init__(self, httpclient)
+    def __init__(self, httpclient, apicache=None):
+        ApiClient.__init__(self, httpclient, apicache)
         self._repositories = None
         self._requests = None
 
@@ -431,10 +824,9 @@ class Api10Client(ApiClient):
                                 id, { field: value })
 
     def _upload_diff(self, id, diff, parentdiff=""):
-        data = {'path': {'filename': 'diff', 'content': diff}}
+        data = {'path': diff_file('diff', diff)}
         if parentdiff:
-            data['parent_diff_path'] = \
-                {'filename': 'parent_diff', 'content': parentdiff}
+            data['parent_diff_path'] = diff_file('parent_diff', parentdiff)
         rsp = self._api_post('/api/json/reviewrequests/%s/diff/new/' % \
                                 id, {}, data)
 
@@ -452,28 +844,64 @@ class Api10Client(ApiClient):
     def _save_draft(self, id):
         self._api_post("/api/json/reviewrequests/%s/draft/save/" % id )
 
-def make_rbclient(url, username, password, proxy=None, apiver=''):
-    httpclient = HttpClient(url, proxy)
-
-    if not httpclient.has_valid_cookie():
+def detect_api_version(httpclient):
+    """
+    Asks the server whether it supports API version 2.0. Returns the version
+    and the URI templates of the root resource (empty for 1.0).
+    Network errors are raised rather than taken for an old server.
+    """
+    try:
+        rsp = httpclient.api_request('GET', '/api/')
+    except urllib2.HTTPError, e:
+        if e.code != 404:
+            raise
+        return '1.0', {}
+    except (ReviewBoardError, ValueError):
+        return '1.0', {}
+    return '2.0', (rsp or {}).get('uri_templates', {})
+
+def make_rbclient(url, username, password, proxy=None, apiver='',
+                  apicache=None, response_cache=None, connection_pool=None,
+                  preemptive_auth=False, api_token=None, diffindex=None):
+    httpclient = HttpClient(url, proxy, response_cache, connection_pool,
+                            preemptive_auth)
+    if apicache is None:
+        apicache = ApiVersionCache()
+
+    if api_token:
+        # Load the cookies all the same, saving them would drop the others.
+        httpclient.has_valid_cookie()
+        if username and password:
+            httpclient.set_credentials(username, password)
+        httpclient.set_api_token(api_token)
+    elif not httpclient.has_valid_cookie():
         if not username:
             username = mercurial.ui.ui().prompt('Username: ')
         if not password:
             password = getpass.getpass('Password: ')
         httpclient.set_credentials(username, password)
+    elif username and password:
+        # Used if the session expires.
+        httpclient.set_credentials(username, password)
 
+    uri_templates = {}
     if not apiver:
-        # Figure out whether the server supports API version 2.0
-        try:
-            httpclient.api_request('GET', '/api/')
-            apiver = '2.0'
-        except:
-            apiver = '1.0'
+        # Figure out whether the server supports API version 2.0, unless
+        # we already know it from a previous run.
+        entry = apicache.get(httpclient.url)
+        if entry:
+            apiver = entry['apiver']
+            uri_templates = entry['uri_templates']
+        else:
+            apiver, uri_templates = detect_api_version(httpclient)
+            apicache.set(httpclient.url, apiver, uri_templates)
 
     if apiver == '2.0':
-        return Api20Client(httpclient)
+        if diffindex is None:
+            diffindex = DiffDigestIndex()
+        return Api20Client(httpclient, apicache, uri_templates, diffindex)
     elif apiver == '1.0':
-        cli = Api10Client(httpclient)
+        cli = Api10Client(httpclient, apicache)
         cli.login(username, password)
         return cli
     else:
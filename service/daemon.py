@@ -0,0 +1,260 @@
+""" Runs the nag service (see service/main.py) as a long-running daemon.
+
+    Instead of being started by cron for every scan, the process stays
+    resident and scans on its own schedule: every --interval seconds or at
+    the times matching a --cron expression ('minute hour day month weekday'
+    with '*', lists, ranges and steps, e.g. '*/30 9-18 * * 1-5'). The RB
+    client with its connection pool, the caches, the Slack directory and the
+    review requests are kept between the scans, which always sync
+    incrementally, so a scan only does the work for what has changed.
+
+    With --webhook-port, RB webhooks (see service/webhooks.py) keep the
+    review requests and whose turn it is on them up to date, and the scans
+    use that state without asking RB. RB is then only polled to reconcile
+    the state every --reconcile-interval seconds, in case a webhook was
+    missed. This needs the store (service/store.py).
+
+    SIGHUP re-reads the config and sets everything up anew. SIGTERM and
+    SIGINT stop the daemon once the running scan is done (a second SIGINT
+    stops it right away).
+
+    The options not listed here are those of service/main.py.
+"""
+
+import ConfigParser
+import argparse
+import datetime
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from multiprocessing.pool import ThreadPool
+from service import main
+from service.webhooks import WebhookListener, is_loopback
+
+DEFAULT_INTERVAL = 15 * 60
+COMPACT_INTERVAL = 24 * 60 * 60
+RECONCILE_INTERVAL = 6 * 60 * 60
+
+
+class IntervalSchedule(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next_run(self, after):
+        return after + self.seconds
+
+
+class CronSchedule(object):
+    """
+    The times matching a five field cron expression @expr.
+    """
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != len(self.FIELDS):
+            raise ValueError("a cron expression has 5 fields: %r" % (expr,))
+        (self.minutes, self.hours, self.days, self.months,
+         self.weekdays) = [_parse_field(field, low, high) for field, (low, high)
+                           in zip(fields, self.FIELDS)]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def next_run(self, after):
+        """
+        Returns the timestamp of the first matching minute after the @after
+        timestamp.
+        """
+        t = datetime.datetime.fromtimestamp(after).replace(second=0,
+                                                           microsecond=0)
+        t += datetime.timedelta(minutes=1)
+        limit = t + datetime.timedelta(days=5 * 366)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) +
+                     datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = (t.replace(hour=0, minute=0) +
+                     datetime.timedelta(days=1))
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(t.timetuple())
+        raise ValueError("the cron expression never matches")
+
+    def _day_matches(self, t):
+        day = t.day in self.days
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        # Like cron, if both are restricted either of them has to match.
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def _parse_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(v) for v in part.split('-', 1)]
+        else:
+            start = int(part)
+            end = high if step != 1 else start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError("invalid cron field: %r" % (field,))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Daemon(object):
+    """
+    Scans according to @schedule with the service/main.py options @argv
+    until it's stopped by a signal. With a WebhookListener @listener, RB is
+    only polled every @reconcile_interval seconds.
+    """
+    def __init__(self, argv, schedule, make_pool=ThreadPool, listener=None,
+                 reconcile_interval=RECONCILE_INTERVAL):
+        self.argv = argv
+        self.schedule = schedule
+        self.make_pool = make_pool
+        self.listener = listener
+        self.reconcile_interval = reconcile_interval
+        self.session = None
+        self._wake = threading.Event()
+        self._stopping = False
+        self._reloading = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        self.session = self._make_session()
+        if self.listener:
+            self.listener.secret = read_webhook_secret()
+            self.listener.start()
+        last_compact = time.time()
+        last_reconcile = 0
+        next_run = time.time()
+        try:
+            while True:
+                self._wake.wait(max(next_run - time.time(), 0))
+                self._wake.clear()
+                if self._stopping:
+                    break
+                if self._reloading:
+                    print "Reloading"
+                    self._reloading = False
+                    self.session.close()
+                    self.session = None
+                    self.session = self._make_session()
+                    if self.listener:
+                        self.listener.secret = read_webhook_secret()
+                if time.time() < next_run:
+                    continue
+
+                started = time.time()
+                sync = (not self.listener or
+                        started - last_reconcile > self.reconcile_interval)
+                self._scan(sync)
+                if sync:
+                    last_reconcile = started
+                if time.time() - last_compact > COMPACT_INTERVAL:
+                    self.session.compact()
+                    last_compact = time.time()
+                next_run = self.schedule.next_run(started)
+        finally:
+            print "Shutting down"
+            if self.listener:
+                self.listener.stop()
+            if self.session:
+                self.session.close()
+
+    def _make_session(self):
+        args = main.parse_args(self.argv)
+        args.incremental = True
+        return main.Session(args)
+
+    def _scan(self, sync):
+        print "Scan started at %s" % (time.ctime(),)
+        try:
+            if self.listener:
+                self.session.apply_webhooks(self.listener.drain())
+            self.session.scan(self.make_pool, sync)
+        except Exception:
+            # Keep running, the next scan may well succeed.
+            traceback.print_exc()
+        self.session.save()
+        sys.stdout.flush()
+
+    def _on_stop(self, signum, frame):
+        if self._stopping and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        self._stopping = True
+        self._wake.set()
+
+    def _on_reload(self, signum, frame):
+        self._reloading = True
+        self._wake.set()
+
+
+def read_webhook_secret():
+    config = ConfigParser.RawConfigParser()
+    config.read(main.CFG_FILE)
+    if config.has_option('auth', 'webhook_secret'):
+        return config.get('auth', 'webhook_secret')
+    return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Run the review request nag service as a daemon.')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--interval', type=int, default=DEFAULT_INTERVAL,
+        metavar='SECONDS',
+        help='time between the starts of two scans (default: %(default)s)')
+    group.add_argument('--cron', metavar='EXPR',
+        help="scan at the times matching a cron expression, e.g. "
+             "'*/30 9-18 * * 1-5' (local time)")
+    parser.add_argument('--webhook-port', type=int, metavar='PORT',
+        help='listen for RB webhooks on this port')
+    parser.add_argument('--webhook-host', default='127.0.0.1', metavar='HOST',
+        help='address to listen for RB webhooks on, any but a loopback one '
+             'needs the webhook_secret (default: %(default)s)')
+    parser.add_argument('--reconcile-interval', type=int,
+        default=RECONCILE_INTERVAL, metavar='SECONDS',
+        help='how often RB is polled when webhooks are used '
+             '(default: %(default)s)')
+    args, main_argv = parser.parse_known_args(argv)
+    if args.webhook_port and not main.parse_args(main_argv).store:
+        parser.error('--webhook-port needs the store')
+    if (args.webhook_port and not is_loopback(args.webhook_host) and
+            not read_webhook_secret()):
+        parser.error('--webhook-host %s needs the webhook_secret in %s' %
+                     (args.webhook_host, main.CFG_FILE))
+    return args, main_argv
+
+
+if __name__ == '__main__':
+    args, main_argv = parse_args(sys.argv[1:])
+    if args.cron:
+        schedule = CronSchedule(args.cron)
+    else:
+        schedule = IntervalSchedule(args.interval)
+    listener = None
+    if args.webhook_port:
+        listener = WebhookListener(args.webhook_host, args.webhook_port)
+    Daemon(main_argv, schedule, listener=listener,
+           reconcile_interval=args.reconcile_interval).run()
@@ -0,0 +1,229 @@
+""" Paced delivery of Slack messages.
+
+    Slack limits chat.postMessage per channel (and every DM is a channel of
+    its own), with a higher limit for the whole workspace on top. Each
+    channel gets a token bucket and so does the workspace, so messages go
+    out as fast as the limits allow but no faster. When Slack throttles us
+    anyway (HTTP 429), the workspace bucket is paused for the Retry-After
+    period and the message is queued for another attempt instead of being
+    lost.
+
+    A message which fails is tried again after an exponential backoff (or
+    the Retry-After period, if longer), so that a short Slack outage
+    doesn't use up all its attempts. The messages posted after it wait
+    behind it, so they still go out in the order they were posted.
+"""
+
+import threading
+import time
+import requests
+
+from collections import deque
+from slacker import Error as SlackError
+
+# chat.postMessage allows about one message per second to a channel, with
+# short bursts, and several hundred a minute to the whole workspace.
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 5
+DEFAULT_WORKSPACE_RATE = 5.0
+DEFAULT_WORKSPACE_BURST = 20
+DEFAULT_RETRY_AFTER = 20
+MAX_ATTEMPTS = 6
+# Seconds to wait before the second attempt, doubled for every next one.
+RETRY_BACKOFF = 2
+MAX_BACKOFF = 60
+
+
+class TokenBucket(object):
+    """
+    Allows @rate calls per second on average and up to @burst at once.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a call is allowed.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now,
+                           (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Allows no calls for the next @seconds (e.g. after HTTP 429).
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._tokens = 0
+
+
+class Message(object):
+    def __init__(self, channel, text, on_sent):
+        self.channel = channel
+        self.text = text
+        self.on_sent = on_sent
+        self.attempt = 1
+        self.retry_at = 0
+        self.sent = False
+
+
+class SlackDispatcher(object):
+    """
+    Posts Slack messages through a token bucket per channel (@rate,
+    @burst) and one for the workspace (@workspace_rate, @workspace_burst).
+    Messages which fail with a transient error are retried after a backoff,
+    the messages posted after them waiting in the queue. flush() waits until
+    the queue is empty.
+    """
+    def __init__(self, slack, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 workspace_rate=DEFAULT_WORKSPACE_RATE,
+                 workspace_burst=DEFAULT_WORKSPACE_BURST,
+                 max_attempts=MAX_ATTEMPTS):
+        self.slack = slack
+        self.rate = rate
+        self.burst = burst
+        self.workspace_rate = workspace_rate
+        self.workspace_burst = workspace_burst
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self._buckets = {}
+        self._queue = deque()
+        self._start = time.time()
+
+    def bucket(self, method, channel=None):
+        """
+        Returns the token bucket for the @method calls on @channel, or for
+        all the @method calls in the workspace if @channel is None.
+        """
+        key = (method, channel)
+        if key not in self._buckets:
+            if channel is None:
+                self._buckets[key] = TokenBucket(self.workspace_rate,
+                                                 self.workspace_burst)
+            else:
+                self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return self._buckets[key]
+
+    def post_message(self, channel, text, on_sent=None):
+        """
+        Posts @text to @channel, waiting for the rate limit if needed.
+        Returns True if the message has been sent (otherwise it's either
+        queued behind a message waiting for a retry, waiting for a retry
+        itself or dropped). @on_sent is called once the message has been
+        sent, possibly by a later call or flush().
+        """
+        message = Message(channel, text, on_sent)
+        self._queue.append(message)
+        self._send_queued()
+        return message.sent
+
+    def flush(self):
+        """
+        Sends the queued messages, waiting for their retries, until all of
+        them are sent or dropped.
+        """
+        while self._queue:
+            wait = self._queue[0].retry_at - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self._send_queued()
+
+    def reset_report(self):
+        """
+        Starts counting the messages for the next report() from zero.
+        """
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self._start = time.time()
+
+    def report(self):
+        elapsed = max(time.time() - self._start, 0.001)
+        return ("Slack: sent %s messages in %.1f s (%.2f msg/s), "
+                "%s retries, %s dropped" % (self.sent, elapsed,
+                self.sent / elapsed, self.retried, self.dropped))
+
+    def _send_queued(self):
+        """
+        Sends the queued messages until one has to wait for its retry.
+        """
+        # Only the first message can be waiting, the others haven't been
+        # tried yet.
+        while self._queue and self._queue[0].retry_at <= time.time():
+            message = self._queue[0]
+            if message.attempt > 1:
+                self.retried += 1
+            if not self._post(message):
+                break
+            self._queue.popleft()
+
+    def _post(self, message):
+        """
+        Tries to send @message. Returns False if it's to be tried again.
+        """
+        self.bucket('chat.postMessage', message.channel).acquire()
+        bucket = self.bucket('chat.postMessage')
+        bucket.acquire()
+        try:
+            self.slack.chat.post_message(message.channel, message.text)
+        except requests.HTTPError, e:
+            if e.response is None or e.response.status_code != 429:
+                return self._failed(message, e)
+            retry_after = _retry_after(e.response)
+            bucket.pause(retry_after)
+            return self._failed(message, e, retry_after)
+        except SlackError, e:
+            if str(e) != 'ratelimited':
+                # The message itself is wrong (e.g. unknown channel).
+                return self._drop(message, e)
+            bucket.pause(DEFAULT_RETRY_AFTER)
+            return self._failed(message, e, DEFAULT_RETRY_AFTER)
+        except requests.RequestException, e:
+            return self._failed(message, e)
+
+        self.sent += 1
+        message.sent = True
+        if message.on_sent:
+            message.on_sent()
+        return True
+
+    def _failed(self, message, error, retry_after=0):
+        if message.attempt >= self.max_attempts:
+            return self._drop(message, error)
+        delay = max(min(RETRY_BACKOFF * 2 ** (message.attempt - 1),
+                        MAX_BACKOFF), retry_after)
+        print "Slack: posting to %s failed (%s), retrying in %s s" % (
+            message.channel, error, delay)
+        message.attempt += 1
+        message.retry_at = time.time() + delay
+        return False
+
+    def _drop(self, message, error):
+        print "Slack: dropping message to %s: %s" % (message.channel, error)
+        self.dropped += 1
+        return True
+
+
+def _retry_after(response):
+    try:
+        return int(response.headers.get('Retry-After', DEFAULT_RETRY_AFTER))
+    except ValueError:
+        # An HTTP date, which Slack doesn't send.
+        return DEFAULT_RETRY_AFTER
@@ -0,0 +1,28 @@
+""" Runs the nag service (see service/main.py) on a gevent event loop.
+
+    The standard library is monkey-patched before anything else gets
+    imported, so the urllib2 transport of the RB client and the Slack client
+    use non-blocking sockets. The review request lookups then run as
+    greenlets in a gevent Pool, which bounds the number of requests in
+    flight (--concurrency, default 50), and the Slack messages are sent from
+    the same loop.
+
+    Requires gevent (pip install gevent).
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import gevent.pool
+
+from service import main
+
+DEFAULT_CONCURRENCY = 50
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not [a for a in argv if a.startswith('--concurrency')]:
+        argv = ['--concurrency', str(DEFAULT_CONCURRENCY)] + argv
+    main.main(argv, make_pool=gevent.pool.Pool)
@@ -0,0 +1,46 @@
+""" The ledger of the nags sent recently.
+
+    A nag is identified by its review request, its recipient (the RB user's
+    href) and the review request's last_updated, so a review request which
+    has been updated since is nagged about again right away. Otherwise the
+    same nag isn't sent again until the suppression window has passed.
+
+    With the store, the ledger is the store's nags table (see
+    service.store.NagLedger). Without it, it's kept in a JSON file.
+"""
+
+import time
+
+from rb.cache import TTLCache
+
+LEDGER_SIZE = 10000
+
+
+def nag_key(req, recipient):
+    return '%s %s %s' % (req['id'], recipient, req['last_updated'])
+
+
+class NagLedger(object):
+    """
+    The nags sent in the last @window seconds, saved to @filename (if
+    given) between runs.
+    """
+    def __init__(self, window, filename=None):
+        self.window = window
+        self._cache = TTLCache(LEDGER_SIZE, window, filename)
+
+    def suppressed(self, req, recipient):
+        """
+        Returns True if @recipient has been nagged about @req (as last
+        updated) within the window.
+        """
+        return self._cache.get(nag_key(req, recipient)) is not None
+
+    def record(self, req, recipient, sent_at=None):
+        self._cache.set(nag_key(req, recipient), sent_at or time.time())
+
+    def load(self):
+        self._cache.load()
+
+    def save(self):
+        self._cache.save()
@@ -5,6 +5,9 @@
     have been approved (there must be at least 1 review request for the story in
     order for the service to notice it).
 
+    It can also stay resident and scan on its own schedule, see
+    service/daemon.py.
+
     The service expects a '${HOME}/.workflow.cfg' file with the following
     structure:
 
@@ -12,6 +15,15 @@
     pt_token = <PT_token>
     rb_user = <reviewboard username>
     rb_pwd = <password for the reviewboard user>
+    rb_api_token = <reviewboard API token (optional, used instead of rb_pwd)>
+
+    [calendar]
+    holidays = <YYYY-MM-DD dates separated by commas (optional)>
+    workday_start = <hour the working day starts at (optional, default 0)>
+    workday_end = <hour the working day ends at (optional, default 24)>
+
+    The review request age and idle time are measured in working days and
+    working hours of this calendar.
 
     The users (in PT & RB) should have access to all the projects (otherwise the
     service will not be able to update all the stories).
@@ -20,17 +32,43 @@
 import os
 import sys
 import re
+import argparse
+import itertools
 import rb.extensions
 import ConfigParser
-import dateutil.parser
-import datetime
 
+from collections import OrderedDict
+from config import metadata_filename
+from multiprocessing.pool import ThreadPool
+from rb.cache import ResponseCache, TTLCache
+from service import scoring, webhooks
+from service.dispatcher import (SlackDispatcher, DEFAULT_RATE, DEFAULT_BURST,
+                                DEFAULT_WORKSPACE_RATE)
+from service.ledger import NagLedger
+from service.slack_directory import LookupFailed, SlackDirectory
+from service.store import Store, NAG_RETENTION
+from service.sync import ReviewRequestState
+from service.workdays import WorkCalendar, parse_holidays
 from slacker import Slacker
-from dateutil.tz import tzlocal
-from dateutil.relativedelta import relativedelta as delta
-from dateutil import rrule
 
 CFG_FILE = '%s/.workflow.cfg' % os.environ['HOME']
+USER_CACHE_FILE = '%s/.workflow-users.json' % os.environ['HOME']
+USER_CACHE_TTL = 24 * 60 * 60
+USER_CACHE_SIZE = 1000
+SLACK_DIRECTORY_FILE = '%s/.workflow-slack-users.json' % os.environ['HOME']
+SLACK_DIRECTORY_TTL = 24 * 60 * 60
+STATE_FILE = '%s/.workflow-review-requests.json' % os.environ['HOME']
+HTTP_CACHE_FILE = '%s/.workflow-http-cache.json' % os.environ['HOME']
+HTTP_CACHE_SIZE = 64
+NAG_LEDGER_FILE = '%s/.workflow-nags.json' % os.environ['HOME']
+NAG_WINDOW = 24 * 60 * 60
+STORE_FILE = '%s/.%s' % (os.environ['HOME'], metadata_filename)
+
+REQUEST_URL = 'https://review.salsitasoft.com/r/%s'
+
+# Orders in which the collected nags can be posted to Slack.
+ORDER_REQUEST = 'request'
+ORDER_RECIPIENT = 'recipient'
 
 
 class RB_daemon_error(Exception):
@@ -47,103 +85,502 @@ def try_except(fn):
     return wrapped
 
 
-@try_except
-def notify_user(auth, user_obj, req):
-    rb_user = rb.extensions.get_user_data(auth, user_obj['href'])
-    if not rb_user:
-        return
-
-    pt_user = _slack_email_dict.get(rb_user['email'], None)
+class Nag(object):
+    """
+    A message to be posted to a Slack user about a review request.
+    """
+    def __init__(self, req, user_href, slack_user, msg, idle_days):
+        self.req = req
+        self.user_href = user_href
+        self.slack_user = slack_user
+        self.msg = msg
+        self.idle_days = idle_days
+
+    @property
+    def nags(self):
+        return [self]
+
+
+class Digest(object):
+    """
+    A single Slack message about all the @nags for @slack_user.
+    """
+    def __init__(self, slack_user, nags):
+        self.slack_user = slack_user
+        self.nags = nags
+        self.idle_days = max(nag.idle_days for nag in nags)
+
+    @property
+    def msg(self):
+        if len(self.nags) == 1:
+            return self.nags[0].msg
+
+        lines = ["%s, you have %s lonely review requests waiting on your "
+                 "action:" % (self.slack_user.real_name, len(self.nags))]
+        for nag in self.nags:
+            line = "- %s (repo %s)" % (REQUEST_URL % (nag.req['id'],),
+                                       nag.req['links']['repository']['title'])
+            if nag.idle_days > scoring.SERIOUS_IDLE_DAYS:
+                line += " *lying there for %s days*" % (nag.idle_days,)
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def make_nag(rb_api, user_obj, req, score):
+    """
+    Returns the Nag for RB user @user_obj about @req (scored @score) or None
+    if the user can't be nagged.
+    """
+    pt_user = get_slack_user(rb_api, user_obj['href'])
     if not pt_user:
-        return
-
-    last_updated = dateutil.parser.parse(req['last_updated'])
-    now = datetime.datetime.now(tzlocal())
-    idle_days = delta(now, last_updated).days
-    idle_hours = delta(now, last_updated).hours + 24 * idle_days
-
-    if idle_hours < 20:
-        print ("review request %s from %s has been idle for %s hours => not nagging" % 
-            (req['id'], pt_user['profile']['real_name'], idle_hours))
-        return
+        return None
 
     msg = ("%s, you have a lonely review request (repo %s) waiting on your action at: " +
-          "https://review.salsitasoft.com/r/%s .") % (
-                  pt_user['profile']['real_name'],
+          REQUEST_URL + " .") % (
+                  pt_user.real_name,
                   req['links']['repository']['title'],
                   req['id'])
 
-    if idle_days > 2:
+    if score.tier == scoring.TIER_SERIOUS:
         msg += ("*This is getting serious*. " +
-            "It's been lying there for *%s days* now!" % (idle_days,))
-
-    print " >>> %s" % (msg,)
-    print " >>> idle for: %s days" % (idle_days,)
+            "It's been lying there for *%s days* now!" % (score.idle_days,))
+
+    return Nag(req, user_obj['href'], pt_user, msg, score.idle_days)
+
+
+def get_slack_user(rb_api, href):
+    """
+    Returns the Slack member for the RB user at @href or None if there's no
+    such member.
+
+    The RB user's email is cached by @href. Users without a Slack account
+    are cached too (as None), so they are skipped without an API call.
+    Raises LookupFailed (and caches nothing) if the Slack member can't be
+    looked up now.
+    """
+    email = _user_cache.get(href, _MISSING)
+    if email is _MISSING:
+        rb_user = rb.extensions.get_user_data(rb_api, href)
+        email = rb_user and rb_user['email']
+        if not _slack_directory.get(email):
+            email = None
+        _user_cache.set(href, email)
+
+    if email is None:
+        return None
+    return _slack_directory.get(email)
+
+
+def send_nag(nag):
+    print " >>> %s" % (nag.msg,)
+    print " >>> idle for: %s days" % (nag.idle_days,)
+
+    def record_nags():
+        for n in nag.nags:
+            _ledger.record(n.req, n.user_href)
+
+    _dispatcher.post_message('@' + nag.slack_user.name, nag.msg, record_nags)
+
+
+def get_last_update(rb_api, req):
+    """
+    Returns the last-update info of @req. It's only fetched from RB if @req
+    has been updated since it was stored.
+    """
+    if _store:
+        last_update = _store.get_last_update(req)
+        if last_update:
+            return last_update
+    last_update = rb.extensions.get_last_update_info(rb_api, req['id'])
+    if last_update and _store:
+        _store.set_last_update(req, last_update)
+    return last_update
+
+
+def get_waiting_users(req, last_update):
+    """
+    Returns the RB user objects whose turn it is to act on @req, given its
+    @last_update info.
+    """
+    if last_update['type'] in ('review-request', 'diff'):
+        return req['target_people']
+
+    if last_update['type'] == 'reply' or last_update['type'] == 'review':
+        if (last_update['user']['links']['self']['href'] ==
+                req['links']['submitter']['href']):
+            # Last review came from request submitter, now it's reviewer's turn.
+            return req['target_people']
+        else:
+            return [req['links']['submitter']]
+
+    return []
 
-    _slack.chat.post_message('@' + pt_user['name'], msg)
 
+@try_except
+def process_request(rb_api, req, score):
+    """
+    Does all the RB lookups for @req, given its staleness @score. Returns
+    a (log, nags) pair, the log being the progress messages to print.
+
+    It doesn't print or post anything itself, so it can run in a worker
+    thread while the output stays the same as for a serial run.
+    """
+    log = []
+    nags = []
+    # Check review request is at least two days old.
+    if score.tier == scoring.TIER_YOUNG:
+        return log, nags
+
+    if score.tier == scoring.TIER_RECENT:
+        log.append("review request %s has been idle for %d work hours "
+                   "=> not nagging" % (req['id'], score.idle_hours))
+        return log, nags
+
+    last_update = get_last_update(rb_api, req)
+    if not last_update:
+        return log, nags
+
+    log.append('processing rid %s %s' % (req['id'], last_update['type']))
+    for user_obj in get_waiting_users(req, last_update):
+        # Check the ledger first, a suppressed nag needs no user lookups.
+        if _ledger.suppressed(req, user_obj['href']):
+            log.append("rid %s: %s has been nagged already => not nagging" %
+                (req['id'], user_obj['href']))
+            continue
+        try:
+            nag = make_nag(rb_api, user_obj, req, score)
+        except LookupFailed, e:
+            log.append("rid %s: couldn't look up the Slack member of %s (%s)"
+                       " => not nagging this time" %
+                       (req['id'], user_obj['href'], e))
+            continue
+        if nag:
+            nags.append(nag)
+    return log, nags
+
+
+def map_requests(fn, reqs, concurrency, make_pool=ThreadPool):
+    """
+    Applies @fn to all @reqs using a pool of up to @concurrency workers
+    created by @make_pool (a ThreadPool or a gevent Pool). The results are
+    yielded in the order of @reqs.
+    """
+    if concurrency <= 1:
+        for result in itertools.imap(fn, reqs):
+            yield result
+        return
 
-def get_work_days_diff(a, b):
-    return len(list(rrule.rrule(rrule.DAILY,
-        dtstart=a,
-        until=b,
-        byweekday=(rrule.MO, rrule.TU, rrule.WE, rrule.TH, rrule.FR))))
-
+    pool = make_pool(concurrency)
+    try:
+        for result in pool.imap(fn, reqs):
+            yield result
+    finally:
+        if hasattr(pool, 'terminate'):
+            pool.terminate()
+        else:
+            pool.kill()
+
+
+def order_nags(nags, order):
+    if order == ORDER_RECIPIENT:
+        # sorted() is stable, so each user's nags keep the request order.
+        return sorted(nags, key=lambda nag: nag.slack_user.name)
+    return nags
+
+
+def make_digests(nags):
+    """
+    Groups @nags by Slack user, keeping the order of the users' first nags.
+    """
+    by_user = OrderedDict()
+    for nag in nags:
+        by_user.setdefault(nag.slack_user.id, []).append(nag)
+    return [Digest(user_nags[0].slack_user, user_nags)
+            for user_nags in by_user.itervalues()]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Nag Slack users about review requests waiting on them.')
+    parser.add_argument('--concurrency', type=int, default=1, metavar='N',
+        help='number of review requests to look up in parallel (default: 1)')
+    parser.add_argument('--page-parallelism', type=int, default=1,
+        metavar='N',
+        help='number of review request list pages to fetch at once '
+             '(default: 1)')
+    parser.add_argument('--store', default=STORE_FILE, metavar='PATH',
+        help='SQLite database keeping the review requests, users, Slack '
+             'members and sent nags between runs; pass an empty string to '
+             'use the JSON files below instead (default: %(default)s)')
+    parser.add_argument('--incremental', action='store_true',
+        help='only fetch the review requests changed since the last run '
+             '(the others are kept in the store)')
+    parser.add_argument('--state-file', default=STATE_FILE, metavar='PATH',
+        help='file keeping the open review requests between incremental '
+             'runs without a store (default: %(default)s)')
+    parser.add_argument('--order', choices=[ORDER_REQUEST, ORDER_RECIPIENT],
+        default=ORDER_REQUEST,
+        help='order of the Slack posts: by review request (default) '
+             'or grouped by recipient')
+    parser.add_argument('--digest', action='store_true',
+        help='send each user a single message listing all their pending '
+             'review requests')
+    parser.add_argument('--slack-rate', type=float, default=DEFAULT_RATE,
+        metavar='N',
+        help='average number of Slack messages per second to one user '
+             '(default: %(default)s)')
+    parser.add_argument('--slack-burst', type=int, default=DEFAULT_BURST,
+        metavar='N',
+        help='number of Slack messages that can be sent to one user at once '
+             '(default: %(default)s)')
+    parser.add_argument('--slack-workspace-rate', type=float,
+        default=DEFAULT_WORKSPACE_RATE, metavar='N',
+        help='average number of Slack messages per second to all the users '
+             '(default: %(default)s)')
+    parser.add_argument('--http-cache', action='store_true',
+        help='cache RB API responses and revalidate them with conditional '
+             'requests (ETag / If-Modified-Since)')
+    parser.add_argument('--http-cache-size', type=int, default=HTTP_CACHE_SIZE,
+        metavar='MB',
+        help='maximum size of the cached responses (default: %(default)s)')
+    parser.add_argument('--http-cache-file', default=HTTP_CACHE_FILE,
+        metavar='PATH',
+        help='file keeping the cached responses between runs; pass an empty '
+             'string to keep them in memory only (default: %(default)s)')
+    parser.add_argument('--user-cache-ttl', type=int, default=USER_CACHE_TTL,
+        metavar='SECONDS',
+        help='how long RB user lookups are cached (default: %(default)s)')
+    parser.add_argument('--user-cache-file', default=USER_CACHE_FILE,
+        metavar='PATH',
+        help='file keeping the RB user cache between runs without a store; '
+             'pass an empty string to keep it in memory only '
+             '(default: %(default)s)')
+    parser.add_argument('--slack-directory-ttl', type=int,
+        default=SLACK_DIRECTORY_TTL, metavar='SECONDS',
+        help='how often the Slack member index is rebuilt '
+             '(default: %(default)s)')
+    parser.add_argument('--slack-directory-file', default=SLACK_DIRECTORY_FILE,
+        metavar='PATH',
+        help='file keeping the Slack member index between runs without '
+             'a store; pass an empty string to keep it in memory only '
+             '(default: %(default)s)')
+    parser.add_argument('--nag-window', type=int, default=NAG_WINDOW,
+        metavar='SECONDS',
+        help='how long a nag is not repeated unless the review request is '
+             'updated; 0 repeats it on every run (default: %(default)s)')
+    parser.add_argument('--nag-ledger-file', default=NAG_LEDGER_FILE,
+        metavar='PATH',
+        help='file keeping the sent nags between runs without a store; '
+             'pass an empty string to keep them in memory only '
+             '(default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+_MISSING = object()
 
 _slack = None
-_slack_email_dict = {}
-
-def main():
-    global _slack
-    global _slack_email_dict
-
-    # Read the sensitive data from a config file.
-    config = ConfigParser.RawConfigParser()
-    config.read(CFG_FILE)
-
-    pt_token = config.get('auth', 'pt_token')
-    rb_user = config.get('auth', 'rb_user')
-    rb_pwd = config.get('auth', 'rb_pwd')
-    slack_token = config.get('auth', 'slack_token')
-
-    # HACK: Set the gobal vars.
-    _slack = Slacker(slack_token)
-    members = _slack.users.list().body['members']
-    _slack_email_dict = dict([[u['profile']['email'], u] for u in members])
-
-    auth = {'username': rb_user, 'password': rb_pwd}
-
-    # Returns all published unshipped requests.
-    reqs = rb.extensions.get_review_requests2(
-        {'max-results': 200, 'ship-it': 0}, auth)
-
-    for req in reqs:
-        added = dateutil.parser.parse(req['time_added'])
-        # Check review request is at least two days old.
-        days_delta = get_work_days_diff(added, datetime.datetime.now(tzlocal()))
-        if days_delta >= 2:
-            last_update = rb.extensions.get_last_update_info(auth, req['id'])
-
-            print 'processing rid', req['id'], last_update['type']
-
-            if last_update['type'] == 'review-request':
-                for reviewer in req['target_people']:
-                    notify_user(auth, reviewer, req)
-                continue
-
-            if last_update['type'] == 'diff':
-                for reviewer in req['target_people']:
-                    notify_user(auth, reviewer, req)
-                continue
-
-            if last_update['type'] == 'reply' or last_update['type'] == 'review':
-                if last_update['user']['links']['self']['href'] == req['links']['submitter']['href']:
-                    # Last review came from request submitter, now it's reviewer's turn.
-                    for reviewer in req['target_people']:
-                        notify_user(auth, reviewer, req)
-                else:
-                    notify_user(auth, req['links']['submitter'], req)
-                continue
+_slack_directory = None
+_dispatcher = None
+_store = None
+_user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_ledger = NagLedger(NAG_WINDOW)
+_calendar = WorkCalendar()
+
+
+def read_calendar(config):
+    """
+    Returns the WorkCalendar described by the optional [calendar] section of
+    @config.
+    """
+    kwargs = {}
+    if config.has_section('calendar'):
+        if config.has_option('calendar', 'holidays'):
+            kwargs['holidays'] = parse_holidays(
+                config.get('calendar', 'holidays'))
+        for option in ('workday_start', 'workday_end'):
+            if config.has_option('calendar', option):
+                kwargs[option] = config.getfloat('calendar', option)
+    return WorkCalendar(**kwargs)
+
+
+class Session(object):
+    """
+    The clients, caches and state the scans need, set up from the parsed
+    command line @args. main() uses a session for a single scan, the daemon
+    (service/daemon.py) keeps one for many, so that everything stays warm.
+    """
+    def __init__(self, args):
+        global _slack
+        global _slack_directory
+        global _dispatcher
+        global _user_cache
+        global _store
+        global _calendar
+        global _ledger
+
+        self.args = args
+
+        _store = None
+        if args.store:
+            _store = Store(args.store)
+            _user_cache = _store.user_cache(args.user_cache_ttl)
+            _ledger = _store.nag_ledger(args.nag_window)
+        else:
+            _user_cache = TTLCache(USER_CACHE_SIZE, args.user_cache_ttl,
+                                   args.user_cache_file or None)
+            _ledger = NagLedger(args.nag_window, args.nag_ledger_file or None)
+        _user_cache.load()
+        _ledger.load()
+
+        # Read the sensitive data from a config file.
+        config = ConfigParser.RawConfigParser()
+        config.read(CFG_FILE)
+
+        pt_token = config.get('auth', 'pt_token')
+        rb_user = config.get('auth', 'rb_user')
+        rb_pwd = config.get('auth', 'rb_pwd')
+        slack_token = config.get('auth', 'slack_token')
+        rb_api_token = None
+        if config.has_option('auth', 'rb_api_token'):
+            rb_api_token = config.get('auth', 'rb_api_token')
+        _calendar = read_calendar(config)
+
+        # HACK: Set the gobal vars.
+        _slack = Slacker(slack_token)
+        _slack_directory = SlackDirectory(_slack,
+                                          args.slack_directory_file or None,
+                                          args.slack_directory_ttl, _store)
+        _slack_directory.load()
+        _dispatcher = SlackDispatcher(_slack, args.slack_rate, args.slack_burst,
+                                      args.slack_workspace_rate)
+
+        self.response_cache = None
+        if args.http_cache:
+            self.response_cache = ResponseCache(
+                args.http_cache_size * 1024 * 1024,
+                args.http_cache_file or None)
+            self.response_cache.load()
+
+        auth = {'username': rb_user, 'password': rb_pwd}
+        # Authenticate preemptively, so that no request needs a 401 round trip.
+        self.rb_api = rb.extensions.get_rbclient(
+            auth, response_cache=self.response_cache, preemptive_auth=True,
+            api_token=rb_api_token)
+
+        self.state = None
+        if args.incremental:
+            self.state = ReviewRequestState(args.state_file, store=_store)
+            self.state.load()
+
+    def scan(self, make_pool=ThreadPool, sync=True):
+        """
+        Looks at all the open review requests and posts the nags. Without
+        @sync, an incremental session uses the review requests it has (as
+        kept up to date by apply_webhooks()) instead of asking RB.
+        """
+        args = self.args
+        rb_api = self.rb_api
+        _slack_directory.refresh_if_expired()
+        _dispatcher.reset_report()
+
+        # All published unshipped requests.
+        options = {'max-results': 200, 'ship-it': 0}
+        if self.state and not sync:
+            reqs = self.state.review_requests()
+        elif self.state:
+            reqs = self.state.sync(rb_api, options, args.page_parallelism)
+            self.state.save()
+        else:
+            # The worker pool consumes the requests as the pages arrive, so
+            # the first page is processed while the next one is being
+            # downloaded.
+            reqs = rb_api.iter_review_requests(options, args.page_parallelism)
+
+        # Do the RB lookups (possibly in parallel) and post the nags in
+        # a deterministic order. In request order they can go out as soon as
+        # the lookups for their request are done.
+        nags = []
+        # Score the staleness of the requests in batches first, so that only
+        # those worth a nag need RB lookups.
+        scored = scoring.iter_scored(reqs, _calendar)
+        results = map_requests(lambda item: process_request(rb_api, *item),
+                               scored, args.concurrency, make_pool)
+        for log, req_nags in results:
+            for line in log:
+                print line
+            if args.order == ORDER_REQUEST and not args.digest:
+                for nag in req_nags:
+                    send_nag(nag)
+            else:
+                nags.extend(req_nags)
+
+        nags = order_nags(nags, args.order)
+        if args.digest:
+            nags = make_digests(nags)
+        for nag in nags:
+            send_nag(nag)
+        _dispatcher.flush()
+        print _dispatcher.report()
+
+    def apply_webhooks(self, payloads):
+        """
+        Updates the review requests and their last-update info from the RB
+        webhook @payloads (see service/webhooks.py). Needs an incremental
+        session with a store.
+        """
+        for payload in payloads:
+            # The payloads have been taken off the queue already, so a bad
+            # one mustn't lose the others.
+            try:
+                self._apply_webhook(payload)
+            except Exception, e:
+                print "Couldn't apply the %s webhook: %r" % (
+                    payload.get('event'), e)
+        self.state.save()
+
+    def _apply_webhook(self, payload):
+        change = webhooks.review_request_change(payload)
+        if not change:
+            return
+        req, last_update = change
+        if last_update is None:
+            self.state.remove(req['id'])
+        else:
+            self.state.update(req)
+            _store.set_last_update(req, last_update)
+
+    def save(self):
+        """
+        Saves the caches.
+        """
+        _user_cache.save()
+        _ledger.save()
+        _slack_directory.save()
+        if self.response_cache:
+            self.response_cache.save()
+
+    def compact(self):
+        if _store:
+            # Keep the nags as long as they can suppress others.
+            _store.compact(max(NAG_RETENTION, self.args.nag_window),
+                           open_known=self.args.incremental)
+
+    def close(self):
+        rb.extensions.reset_rbclients()
+        self.save()
+        self.compact()
+        if _store:
+            _store.close()
+
+
+def main(argv=None, make_pool=ThreadPool):
+    session = Session(parse_args(argv))
+    try:
+        session.scan(make_pool)
+    finally:
+        # Save the nag ledger and the caches even if the scan failed, or
+        # the nags already sent would be sent again next time.
+        session.close()
 
 
 if __name__ == '__main__':
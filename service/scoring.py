@@ -0,0 +1,151 @@
+""" Batch scoring of review request staleness.
+
+    The review requests are scored a batch at a time: their timestamps are
+    parsed once and packed into arrays, and the work-day age, the idle work
+    hours, the idle days and the escalation tier of the whole batch are
+    computed together (with NumPy when it's installed, one request after
+    another otherwise).
+"""
+
+import datetime
+import itertools
+
+from collections import namedtuple
+from dateutil.tz import tzlocal
+from service.timestamps import parse_timestamp
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BATCH_SIZE = 200
+
+# Review requests younger than this aren't looked at.
+MIN_AGE_WORK_DAYS = 2
+# Review requests updated less than this ago aren't nagged about.
+MIN_IDLE_HOURS = 20
+# Idle for longer than this, the nags get serious.
+SERIOUS_IDLE_DAYS = 2
+
+# Escalation tiers.
+TIER_YOUNG = 0
+TIER_RECENT = 1
+TIER_NAG = 2
+TIER_SERIOUS = 3
+
+Score = namedtuple('Score', 'age_days idle_hours idle_days tier')
+
+
+def iter_scored(reqs, calendar, now=None, batch_size=BATCH_SIZE):
+    """
+    Yields a (review request, Score) pair for each of @reqs. The requests
+    are consumed and scored @batch_size at a time, so they can be streamed.
+    """
+    now = now or datetime.datetime.now(tzlocal())
+    reqs = iter(reqs)
+    while True:
+        batch = list(itertools.islice(reqs, batch_size))
+        if not batch:
+            return
+        for item in zip(batch, score_requests(batch, calendar, now)):
+            yield item
+
+
+def score_requests(reqs, calendar, now=None):
+    """
+    Returns the Scores of @reqs (in the same order) as of @now, measured in
+    the work days and work hours of @calendar.
+    """
+    if not reqs:
+        return []
+    now = calendar.localize(now or datetime.datetime.now(tzlocal()))
+    added = [calendar.localize(parse_timestamp(req['time_added']))
+             for req in reqs]
+    updated = [calendar.localize(parse_timestamp(req['last_updated']))
+               for req in reqs]
+    if numpy is not None:
+        return _score_numpy(calendar, added, updated, now)
+    return _score_python(calendar, added, updated, now)
+
+
+def get_tier(age_days, idle_hours, idle_days):
+    if age_days < MIN_AGE_WORK_DAYS:
+        return TIER_YOUNG
+    if idle_hours < MIN_IDLE_HOURS:
+        return TIER_RECENT
+    if idle_days > SERIOUS_IDLE_DAYS:
+        return TIER_SERIOUS
+    return TIER_NAG
+
+
+def _score_python(calendar, added, updated, now):
+    scores = []
+    for time_added, last_updated in zip(added, updated):
+        age_days = calendar.work_days_diff(time_added, now)
+        idle_hours = calendar.work_hours_between(last_updated, now)
+        idle_days = max((now - last_updated).days, 0)
+        scores.append(Score(age_days, idle_hours, idle_days,
+                            get_tier(age_days, idle_hours, idle_days)))
+    return scores
+
+
+def _score_numpy(calendar, added, updated, now):
+    busdays = {
+        'weekmask': [int(d not in calendar.weekend) for d in range(7)],
+        'holidays': numpy.array(calendar.holidays, dtype='datetime64[D]'),
+    }
+    workday_start = calendar.workday_start * 3600.0
+    workday_end = calendar.workday_end * 3600.0
+
+    # Local dates and seconds since local midnight.
+    now_day = numpy.datetime64(now.date(), 'D')
+    now_sec = _seconds([now])[0]
+    now_is_busday = numpy.is_busday(now_day, **busdays)
+    now_time = now_day.astype('int64') * 86400 + now_sec
+    added_day = numpy.array([d.date() for d in added], dtype='datetime64[D]')
+    added_sec = _seconds(added)
+    added_time = added_day.astype('int64') * 86400 + added_sec
+    updated_day = numpy.array([d.date() for d in updated],
+                              dtype='datetime64[D]')
+    updated_sec = _seconds(updated)
+    updated_time = updated_day.astype('int64') * 86400 + updated_sec
+
+    # Work days from the time added to now, both days included, except for
+    # today if it's earlier in the day than the time added.
+    age_days = numpy.busday_count(added_day, now_day + 1, **busdays)
+    age_days -= now_is_busday & (now_sec < added_sec)
+    age_days = numpy.where(added_time > now_time, 0, age_days)
+
+    # Work hours of the day of the last update, of today and of the whole
+    # work days in between.
+    updated_is_busday = numpy.is_busday(updated_day, **busdays)
+    now_until = min(now_sec, workday_end)
+    first_day = numpy.clip(
+        workday_end - numpy.maximum(updated_sec, workday_start), 0, None)
+    last_day = max(now_until - workday_start, 0) * now_is_busday
+    whole_days = numpy.clip(
+        numpy.busday_count(updated_day + 1, now_day, **busdays), 0, None)
+    same_day = numpy.clip(
+        now_until - numpy.maximum(updated_sec, workday_start), 0, None)
+    idle_seconds = numpy.where(
+        updated_day == now_day, same_day * updated_is_busday,
+        first_day * updated_is_busday + last_day +
+        whole_days * (workday_end - workday_start))
+    idle_hours = numpy.where(updated_time >= now_time, 0, idle_seconds / 3600.0)
+
+    idle_days = numpy.clip((now_time - updated_time) // 86400, 0, None)
+
+    tiers = numpy.select(
+        [age_days < MIN_AGE_WORK_DAYS, idle_hours < MIN_IDLE_HOURS,
+         idle_days > SERIOUS_IDLE_DAYS],
+        [TIER_YOUNG, TIER_RECENT, TIER_SERIOUS], TIER_NAG)
+
+    return [Score(*row) for row in zip(age_days.tolist(), idle_hours.tolist(),
+                                       idle_days.astype('int64').tolist(),
+                                       tiers.tolist())]
+
+
+def _seconds(dts):
+    return numpy.array([d.hour * 3600 + d.minute * 60 + d.second +
+                        d.microsecond / 1e6 for d in dts])
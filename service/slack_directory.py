@@ -0,0 +1,183 @@
+""" A compact, locally persisted index of the Slack workspace members.
+
+    Only the email -> (id, name, real_name) mapping the nag service needs is
+    kept. The index is saved (to a service.store.Store or to a JSON file) and
+    reused until it's older than its TTL. An expired index is still used
+    while a fresh one is downloaded page by page in the background, and
+    members missing from it are looked up one by one by email, so the
+    service never waits for the full member list unless there's no index at
+    all.
+"""
+
+import threading
+import time
+import json
+import requests
+
+from collections import namedtuple
+from rb.reviewboard import atomic_write, load_json_file
+from slacker import Error as SlackError
+
+PAGE_SIZE = 200
+DIRECTORY_TTL = 24 * 60 * 60
+DEFAULT_RETRY_AFTER = 20
+
+
+SlackUser = namedtuple('SlackUser', 'id name real_name')
+
+
+class LookupFailed(Exception):
+    """
+    A member couldn't be looked up (e.g. because of rate limiting), which
+    doesn't mean there's no such member.
+    """
+
+
+def _make_user(member):
+    return SlackUser(member['id'], member['name'],
+                     member['profile'].get('real_name', ''))
+
+
+class SlackDirectory(object):
+    def __init__(self, slack, filename=None, ttl=DIRECTORY_TTL, store=None):
+        self.slack = slack
+        self.filename = filename
+        self.ttl = ttl
+        self.store = store
+        self._users = {} # email -> SlackUser (None if there's no such member)
+        self._timestamp = 0
+        self._changed = False
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._lookups_paused_until = 0
+
+    def load(self):
+        """
+        Loads the saved index. Downloads it if there's none and starts a
+        background refresh if it has expired.
+        """
+        self._load()
+        self.refresh_if_expired()
+
+    def refresh_if_expired(self):
+        """
+        Downloads the index if there's none and starts a background refresh
+        if it has expired (and isn't being refreshed already).
+        """
+        if not self._timestamp:
+            self.refresh()
+        elif (time.time() - self._timestamp > self.ttl and
+                not self._refresh_thread):
+            self._refresh_thread = threading.Thread(target=self.refresh)
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+
+    def get(self, email):
+        """
+        Returns the SlackUser with @email or None if there's no such member.
+        Raises LookupFailed if the member isn't in the index and can't be
+        looked up now.
+        """
+        if not email:
+            return None
+        with self._lock:
+            if email in self._users:
+                return self._users[email]
+        user = self._lookup(email)
+        with self._lock:
+            self._users[email] = user
+            if user:
+                self._changed = True
+        return user
+
+    def refresh(self):
+        """
+        Rebuilds the index from users.list, following the pagination cursor.
+        """
+        users = {}
+        cursor = None
+        while True:
+            params = {'limit': PAGE_SIZE, 'presence': 0}
+            if cursor:
+                params['cursor'] = cursor
+            body = self.slack.users.get('users.list', params=params).body
+            for member in body['members']:
+                email = member['profile'].get('email')
+                if email and not member.get('deleted'):
+                    users[email] = _make_user(member)
+            cursor = body.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+        with self._lock:
+            self._users = users
+            self._timestamp = time.time()
+            self._changed = True
+
+    def save(self):
+        """
+        Saves the index (waiting for a running refresh to finish first).
+        Members that were looked up and not found aren't saved.
+        """
+        if self._refresh_thread:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+        if not self._changed or not (self.store or self.filename):
+            return
+        with self._lock:
+            users = dict((email, list(user))
+                         for email, user in self._users.iteritems() if user)
+            timestamp = self._timestamp
+            self._changed = False
+        if self.store:
+            self.store.save_slack_users(users, timestamp)
+            return
+        data = {'timestamp': timestamp, 'users': users}
+        try:
+            atomic_write(self.filename, json.dumps(data))
+        except (IOError, OSError), e:
+            print("Couldn't save Slack directory: %s" % e)
+
+    def _load(self):
+        if self.store:
+            users, timestamp = self.store.load_slack_users()
+            with self._lock:
+                self._users = dict((email, SlackUser(*user))
+                                   for email, user in users.iteritems())
+                self._timestamp = timestamp
+            return
+        if not self.filename:
+            return
+        data = load_json_file(self.filename)
+        if data is None:
+            return
+        with self._lock:
+            self._users = dict((email, SlackUser(*user))
+                               for email, user in data['users'].iteritems())
+            self._timestamp = data['timestamp']
+
+    def _lookup(self, email):
+        if time.time() < self._lookups_paused_until:
+            raise LookupFailed('rate limited')
+        try:
+            rsp = self.slack.users.get('users.lookupByEmail',
+                                       params={'email': email})
+        except SlackError, e:
+            if str(e) == 'users_not_found':
+                return None
+            if str(e) == 'ratelimited':
+                self._lookups_paused_until = time.time() + DEFAULT_RETRY_AFTER
+            # Or e.g. missing_scope or invalid_auth.
+            raise LookupFailed(e)
+        except requests.HTTPError, e:
+            if e.response is not None and e.response.status_code == 429:
+                try:
+                    retry_after = int(e.response.headers.get(
+                        'Retry-After', DEFAULT_RETRY_AFTER))
+                except ValueError:
+                    retry_after = DEFAULT_RETRY_AFTER
+                self._lookups_paused_until = time.time() + retry_after
+            raise LookupFailed(e)
+        except requests.RequestException, e:
+            raise LookupFailed(e)
+        return _make_user(rsp.body['user'])
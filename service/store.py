@@ -0,0 +1,293 @@
+""" SQLite store for the state the nag service keeps between runs.
+
+    It holds the open review requests with the incremental sync marks, the
+    last-update info of each review request, the RB users (by href), the
+    Slack member index and the history of sent nags.
+
+    Several cron invocations may use the same database at once. The
+    database runs in WAL mode so readers don't block the writer, and every
+    write is a short 'BEGIN IMMEDIATE' transaction which waits (up to
+    LOCK_TIMEOUT seconds) for a concurrent writer instead of failing.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+LOCK_TIMEOUT = 30
+NAG_RETENTION = 30 * 24 * 60 * 60
+# The last-update info of review requests which haven't been updated for
+# this long is evicted, unless the open review requests are known.
+LAST_UPDATE_RETENTION = 90 * 24 * 60 * 60
+# VACUUM once more than this fraction of the database pages is free.
+VACUUM_THRESHOLD = 0.25
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS review_requests (
+    id INTEGER PRIMARY KEY,
+    last_updated TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS review_requests_last_updated
+    ON review_requests (last_updated);
+CREATE TABLE IF NOT EXISTS last_updates (
+    review_request_id INTEGER PRIMARY KEY,
+    review_request_updated TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rb_users (
+    href TEXT PRIMARY KEY,
+    email TEXT,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rb_users_expires ON rb_users (expires);
+CREATE TABLE IF NOT EXISTS slack_users (
+    email TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    real_name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS nags (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    review_request_id INTEGER NOT NULL,
+    recipient TEXT NOT NULL,
+    last_updated TEXT NOT NULL,
+    sent_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nags_review_request
+    ON nags (review_request_id, recipient, last_updated);
+CREATE INDEX IF NOT EXISTS nags_sent_at ON nags (sent_at);
+"""
+
+
+class Store(object):
+    def __init__(self, filename):
+        self.filename = filename
+        # The connection is shared by the worker threads, self._lock
+        # serializes its use.
+        self._conn = sqlite3.connect(filename, timeout=LOCK_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = threading.RLock()
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    # Meta values (JSON encoded).
+
+    def get_meta(self, key, default=None):
+        rows = self._query('SELECT value FROM meta WHERE key = ?', (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_meta(self, key, value):
+        with self._transaction() as conn:
+            self._set_meta(conn, key, value)
+
+    def _set_meta(self, conn, key, value):
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                     (key, json.dumps(value)))
+
+    # Review requests.
+
+    def load_review_requests(self):
+        """
+        Returns a {id: review request} dict of the stored review requests.
+        """
+        return dict((id, json.loads(data)) for id, data in
+                    self._query('SELECT id, data FROM review_requests'))
+
+    def save_review_requests(self, updated, removed, replace_all=False,
+                             meta=None):
+        """
+        Stores the @updated review requests and deletes the ones with ids in
+        @removed (or all the others if @replace_all). The @meta dict is
+        saved in the same transaction.
+        """
+        with self._transaction() as conn:
+            if replace_all:
+                conn.execute('DELETE FROM review_requests')
+            conn.executemany(
+                'INSERT OR REPLACE INTO review_requests '
+                '(id, last_updated, data) VALUES (?, ?, ?)',
+                [(req['id'], req['last_updated'], json.dumps(req))
+                 for req in updated])
+            conn.executemany('DELETE FROM review_requests WHERE id = ?',
+                             [(id,) for id in removed])
+            for key, value in (meta or {}).iteritems():
+                self._set_meta(conn, key, value)
+
+    # Last-update info.
+
+    def get_last_update(self, req):
+        """
+        Returns the last-update info stored for @req, unless @req has been
+        updated since it was fetched.
+        """
+        rows = self._query(
+            'SELECT data FROM last_updates '
+            'WHERE review_request_id = ? AND review_request_updated = ?',
+            (req['id'], req['last_updated']))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set_last_update(self, req, last_update):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO last_updates '
+                '(review_request_id, review_request_updated, data) '
+                'VALUES (?, ?, ?)',
+                (req['id'], req['last_updated'], json.dumps(last_update)))
+
+    # RB users.
+
+    def user_cache(self, ttl):
+        return UserCache(self, ttl)
+
+    # Slack directory.
+
+    def load_slack_users(self):
+        """
+        Returns the stored Slack member index as a {email: (id, name,
+        real_name)} dict and the time it was built.
+        """
+        users = dict((row[0], tuple(row[1:])) for row in self._query(
+            'SELECT email, id, name, real_name FROM slack_users'))
+        return users, self.get_meta('slack_users_timestamp', 0)
+
+    def save_slack_users(self, users, timestamp):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM slack_users')
+            conn.executemany(
+                'INSERT INTO slack_users (email, id, name, real_name) '
+                'VALUES (?, ?, ?, ?)',
+                [(email,) + tuple(user) for email, user in users.iteritems()])
+            self._set_meta(conn, 'slack_users_timestamp', timestamp)
+
+    # Nags.
+
+    def record_nag(self, req, recipient, sent_at=None):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO nags '
+                '(review_request_id, recipient, last_updated, sent_at) '
+                'VALUES (?, ?, ?, ?)',
+                (req['id'], recipient, req['last_updated'],
+                 sent_at or time.time()))
+
+    def nag_ledger(self, window):
+        return NagLedger(self, window)
+
+    def compact(self, nag_retention=NAG_RETENTION, open_known=False):
+        """
+        Evicts expired users, old nags and old last-update info. Vacuums the
+        database if too much of it is free space.
+
+        With @open_known (the review_requests table is kept up to date by an
+        incremental session), the last-update info of the review requests
+        which aren't open anymore is evicted. Otherwise that table may be
+        empty or stale, so the info is evicted by the review request's age.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM rb_users WHERE expires < ?', (now,))
+            conn.execute('DELETE FROM nags WHERE sent_at < ?',
+                         (now - nag_retention,))
+            if open_known:
+                conn.execute(
+                    'DELETE FROM last_updates WHERE review_request_id NOT IN '
+                    '(SELECT id FROM review_requests)')
+            else:
+                # RB timestamps start with the date, so comparing them to
+                # one as strings works whatever their time part looks like.
+                cutoff = time.strftime(
+                    '%Y-%m-%d', time.gmtime(now - LAST_UPDATE_RETENTION))
+                conn.execute(
+                    'DELETE FROM last_updates WHERE review_request_updated < ?',
+                    (cutoff,))
+
+        with self._lock:
+            free = self._conn.execute('PRAGMA freelist_count').fetchone()[0]
+            total = self._conn.execute('PRAGMA page_count').fetchone()[0]
+            if total and float(free) / total > VACUUM_THRESHOLD:
+                try:
+                    self._conn.execute('VACUUM')
+                except sqlite3.OperationalError, e:
+                    # Another process is using the database, try next time.
+                    print "Couldn't vacuum %s: %s" % (self.filename, e)
+
+
+class UserCache(object):
+    """
+    The rb_users table with the interface of rb.cache.TTLCache.
+    """
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def get(self, href, default=None):
+        rows = self.store._query(
+            'SELECT email FROM rb_users WHERE href = ? AND expires >= ?',
+            (href, time.time()))
+        return rows[0][0] if rows else default
+
+    def set(self, href, email):
+        with self.store._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO rb_users (href, email, expires) '
+                'VALUES (?, ?, ?)', (href, email, time.time() + self.ttl))
+
+    def load(self):
+        pass
+
+    def save(self):
+        pass
+
+
+class NagLedger(object):
+    """
+    The nags table with the interface of service.ledger.NagLedger.
+    """
+    def __init__(self, store, window):
+        self.store = store
+        self.window = window
+
+    def suppressed(self, req, recipient):
+        rows = self.store._query(
+            'SELECT 1 FROM nags WHERE review_request_id = ? AND recipient = ? '
+            'AND last_updated = ? AND sent_at >= ? LIMIT 1',
+            (req['id'], recipient, req['last_updated'],
+             time.time() - self.window))
+        return bool(rows)
+
+    def record(self, req, recipient, sent_at=None):
+        self.store.record_nag(req, recipient, sent_at)
+
+    def load(self):
+        pass
+
+    def save(self):
+        pass
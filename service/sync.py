@@ -0,0 +1,151 @@
+""" Incremental synchronization of the open review requests.
+
+    The first run lists all the open review requests. Later runs only ask
+    Review Board for the review requests updated since the newest
+    'last_updated' seen so far (the high-water mark) and merge them into
+    the local copy, so the cost of a run depends on how many review
+    requests have changed rather than on how many there are.
+
+    Each incremental sync makes two queries for the changed review requests:
+    one with the usual filters (to add/update the open ones) and one for
+    any status (so that the ones which have been shipped, submitted or
+    discarded are dropped). A full listing is still done every
+    FULL_SYNC_INTERVAL seconds to recover from anything missed.
+
+    The state is kept either in a service.store.Store, where only the
+    changed review requests are written, or in a JSON file.
+"""
+
+import json
+import time
+
+from rb.reviewboard import atomic_write, load_json_file
+from service.timestamps import parse_timestamp
+
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+
+
+class ReviewRequestState(object):
+    def __init__(self, filename=None, full_sync_interval=FULL_SYNC_INTERVAL,
+                 store=None):
+        self.filename = filename
+        self.full_sync_interval = full_sync_interval
+        self.store = store
+        self.requests = {} # review request id -> review request
+        self.high_water_mark = None
+        self.last_full_sync = 0
+        # Changes since the last load() or save().
+        self._updated = {}
+        self._removed = set()
+        self._replaced = False
+
+    def load(self):
+        if self.store:
+            self.requests = self.store.load_review_requests()
+            self.high_water_mark = self.store.get_meta('high_water_mark')
+            self.last_full_sync = self.store.get_meta('last_full_sync', 0)
+            return
+        if not self.filename:
+            return
+        data = load_json_file(self.filename)
+        if data is None:
+            return
+        self.requests = dict((req['id'], req) for req in data['requests'])
+        self.high_water_mark = data['high_water_mark']
+        self.last_full_sync = data['last_full_sync']
+
+    def save(self):
+        if self.store:
+            self.store.save_review_requests(
+                self._updated.values(), self._removed, self._replaced, {
+                    'high_water_mark': self.high_water_mark,
+                    'last_full_sync': self.last_full_sync,
+                })
+            self._updated = {}
+            self._removed = set()
+            self._replaced = False
+            return
+        if not self.filename:
+            return
+        data = {
+            'high_water_mark': self.high_water_mark,
+            'last_full_sync': self.last_full_sync,
+            'requests': self.requests.values(),
+        }
+        try:
+            atomic_write(self.filename, json.dumps(data))
+        except (IOError, OSError), e:
+            print("Couldn't save review request state: %s" % e)
+
+    def sync(self, rb_api, options, parallelism=1):
+        """
+        Brings the state up to date with the review requests matching
+        @options and returns them, most recently updated first.
+        """
+        full_sync = (self.high_water_mark is None or
+                     time.time() - self.last_full_sync >
+                     self.full_sync_interval)
+        if full_sync:
+            print 'full sync of review requests'
+            self.requests = {}
+            self._updated = {}
+            self._removed = set()
+            self._replaced = True
+            self._update(rb_api.iter_review_requests(options, parallelism))
+            self.last_full_sync = time.time()
+        else:
+            print 'syncing review requests updated since %s' % (
+                self.high_water_mark,)
+            since = {'last-updated-from': self.high_water_mark}
+            open_ids = self._update(rb_api.iter_review_requests(
+                dict(options, **since), parallelism))
+            changed = dict(options, status='all', **since)
+            changed.pop('ship-it', None)
+            for req in rb_api.iter_review_requests(changed, parallelism):
+                self._bump_high_water_mark(req)
+                if req['id'] not in open_ids and req['id'] in self.requests:
+                    del self.requests[req['id']]
+                    self._updated.pop(req['id'], None)
+                    self._removed.add(req['id'])
+
+        return self.review_requests()
+
+    def review_requests(self):
+        """
+        Returns the review requests, most recently updated first.
+        """
+        return sorted(self.requests.values(),
+                      key=lambda req: parse_timestamp(req['last_updated']),
+                      reverse=True)
+
+    def update(self, req):
+        """
+        Adds or updates @req (e.g. from a webhook). The high-water mark isn't
+        moved, so the next incremental sync still fetches anything else
+        changed since the last one.
+        """
+        self.requests[req['id']] = req
+        self._updated[req['id']] = req
+        self._removed.discard(req['id'])
+
+    def remove(self, id):
+        if id in self.requests:
+            del self.requests[id]
+            self._updated.pop(id, None)
+            self._removed.add(id)
+
+    def _update(self, reqs):
+        ids = set()
+        for req in reqs:
+            self.requests[req['id']] = req
+            self._updated[req['id']] = req
+            self._removed.discard(req['id'])
+            self._bump_high_water_mark(req)
+            ids.add(req['id'])
+        return ids
+
+    def _bump_high_water_mark(self, req):
+        if (self.high_water_mark is None or
+                parse_timestamp(req['last_updated']) >
+                parse_timestamp(self.high_water_mark)):
+            self.high_water_mark = req['last_updated']
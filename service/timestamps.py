@@ -0,0 +1,70 @@
+""" Parsing of the timestamps in Review Board payloads.
+
+    RB always formats them the same way (e.g. '2026-10-01T10:00:00Z', with
+    optional microseconds and an optional UTC offset instead of 'Z'), so
+    they are parsed with a regexp instead of dateutil's general parser.
+    Anything else still goes to dateutil.
+"""
+
+import datetime
+import re
+import dateutil.parser
+
+from dateutil.tz import tzoffset, tzutc
+
+MEMO_SIZE = 4096
+
+ISO_8601_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+
+UTC = tzutc()
+
+_memo = {}
+_offsets = {}
+
+
+def parse_timestamp(value):
+    """
+    Returns the datetime for the RB timestamp @value. The recently parsed
+    timestamps are remembered, since the same ones come up again and again.
+    """
+    dt = _memo.get(value)
+    if dt is None:
+        dt = _parse(value)
+        if len(_memo) >= MEMO_SIZE:
+            _memo.clear()
+        _memo[value] = dt
+    return dt
+
+
+def _parse(value):
+    match = ISO_8601_RE.match(value)
+    if not match:
+        return dateutil.parser.parse(value)
+
+    (year, month, day, hour, minute, second,
+     fraction, zone) = match.groups()
+    microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+    if zone is None:
+        tz = None
+    elif zone == 'Z':
+        tz = UTC
+    else:
+        tz = _get_offset(zone)
+    try:
+        return datetime.datetime(int(year), int(month), int(day), int(hour),
+                                 int(minute), int(second), microsecond, tz)
+    except ValueError:
+        return dateutil.parser.parse(value)
+
+
+def _get_offset(zone):
+    tz = _offsets.get(zone)
+    if tz is None:
+        minutes = int(zone[1:3]) * 60 + int(zone[-2:])
+        if zone[0] == '-':
+            minutes = -minutes
+        tz = UTC if minutes == 0 else tzoffset(None, minutes * 60)
+        _offsets[zone] = tz
+    return tz
@@ -0,0 +1,64 @@
+""" Posts recorded RB webhook payloads to a webhook listener, the way Review
+    Board does, for trying out the daemon (service/daemon.py) locally:
+
+    python -m service.daemon --interval 60 --webhook-port 8042 &
+    python -m service.webhook_stub http://localhost:8042/ payloads.json
+
+    The file holds a JSON list of payloads (or a single payload), each with
+    its 'event' name, as found in the RB webhook logs.
+"""
+
+import argparse
+import json
+import sys
+import urllib2
+
+from service.webhooks import sign
+
+
+def post_payload(url, payload, secret=None):
+    """
+    POSTs @payload to @url. Returns the HTTP status code.
+    """
+    body = json.dumps(payload)
+    headers = {
+        'Content-Type': 'application/json',
+        'X-ReviewBoard-Event': payload.get('event', ''),
+    }
+    if secret:
+        headers['X-Hub-Signature'] = sign(secret, body)
+    try:
+        rsp = urllib2.urlopen(urllib2.Request(url, body, headers))
+    except urllib2.HTTPError, e:
+        return e.code
+    rsp.read()
+    return rsp.getcode()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='POST recorded RB webhook payloads to a listener.')
+    parser.add_argument('url', help='URL of the webhook listener')
+    parser.add_argument('payloads', nargs='+', metavar='FILE',
+        help='JSON file with a payload or a list of payloads')
+    parser.add_argument('--secret', help='secret to sign the payloads with')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for filename in args.payloads:
+        with open(filename) as f:
+            payloads = json.load(f)
+        if isinstance(payloads, dict):
+            payloads = [payloads]
+        for payload in payloads:
+            status = post_payload(args.url, payload, args.secret)
+            print "%s %s: %s" % (payload.get('event'),
+                                 payload.get('review_request', {}).get('id'),
+                                 status)
+            if status != 200:
+                failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
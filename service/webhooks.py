@@ -0,0 +1,186 @@
+""" Review Board webhook listener.
+
+    RB can POST a webhook for each review request, review and reply that
+    gets published. Each of them tells whose turn it is on the review
+    request, which is what the nag service otherwise learns by polling the
+    review requests and their last-update info. The listener only queues the
+    payloads, the daemon (service/daemon.py) applies them to its state
+    between the scans.
+
+    The webhooks are set up in the RB admin UI with the JSON encoding and
+    the events below. If they have a secret, it goes in the [auth] section
+    of ~/.workflow.cfg as webhook_secret. The listener only takes unsigned
+    payloads on a loopback address (behind a proxy on the same host), on
+    any other address it needs the secret.
+"""
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import hashlib
+import hmac
+import json
+import socket
+import threading
+import urlparse
+
+from service.timestamps import parse_timestamp
+
+EVENTS = ('review_request_published', 'review_request_reopened',
+          'review_request_closed', 'review_published', 'reply_published')
+
+
+def review_request_change(payload):
+    """
+    Returns a (review request, last-update info) pair for the webhook
+    @payload, the last-update info being in the format of the RB
+    last-update resource (or None if the review request doesn't need any
+    more nags). Returns None for payloads which change nothing. Raises
+    ValueError if @payload lacks something its event needs.
+    """
+    try:
+        return _change(payload)
+    except (AttributeError, KeyError, TypeError), e:
+        raise ValueError("malformed %s payload: %r" % (payload.get('event'),
+                                                       e))
+
+
+def _change(payload):
+    event = payload.get('event')
+    req = payload.get('review_request')
+    if event not in EVENTS or not req:
+        return None
+    int(req['id'])
+
+    if event == 'review_request_closed':
+        return req, None
+
+    if event in ('review_request_published', 'review_request_reopened'):
+        # The review request is kept, so it needs a valid last_updated.
+        parse_timestamp(req['last_updated'])
+        return req, {'type': 'review-request',
+                     'user': _user(req['links']['submitter']['href'])}
+
+    review = payload['review' if event == 'review_published' else 'reply']
+    if review.get('ship_it'):
+        # The service doesn't nag about review requests with a ship it.
+        return req, None
+
+    # Publishing a review doesn't have to change the review request's
+    # last_updated, but the idle time counts from the review.
+    updated = parse_timestamp(req['last_updated'])
+    timestamp = review.get('timestamp')
+    if timestamp and parse_timestamp(timestamp) > updated:
+        req = dict(req, last_updated=timestamp)
+    return req, {'type': 'review' if event == 'review_published' else 'reply',
+                 'user': _user(review['links']['user']['href'])}
+
+
+def _user(href):
+    return {'links': {'self': {'href': href}}}
+
+
+def is_loopback(host):
+    try:
+        return socket.gethostbyname(host).startswith('127.')
+    except socket.error:
+        return False
+
+
+def sign(secret, body):
+    """
+    Returns the X-Hub-Signature header value RB sends for @body.
+    """
+    return 'sha1=' + hmac.new(secret, body, hashlib.sha1).hexdigest()
+
+
+class WebhookListener(object):
+    """
+    An HTTP server on @host:@port queueing the RB webhook payloads it
+    receives. Payloads not signed with @secret (if given) are rejected. On
+    an address other than a loopback one, the secret is required.
+    """
+    def __init__(self, host='127.0.0.1', port=8042, secret=None):
+        self.secret = secret
+        self.loopback = is_loopback(host)
+        self.events = Queue.Queue()
+        self.server = _Server((host, port), _Handler)
+        self.server.listener = self
+        self._thread = None
+
+    def start(self):
+        if not self.secret and not self.loopback:
+            raise ValueError("a webhook listener on %s needs a secret" %
+                             (self.server.server_address[0],))
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def drain(self):
+        """
+        Returns the payloads received since the last call.
+        """
+        payloads = []
+        while True:
+            try:
+                payloads.append(self.events.get_nowait())
+            except Queue.Empty:
+                return payloads
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        listener = self.server.listener
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if not listener.secret and not listener.loopback:
+            # The secret is gone (the config has been reloaded without it).
+            self._respond(403, 'Secret required')
+            return
+        if listener.secret and not hmac.compare_digest(
+                self.headers.get('X-Hub-Signature', ''),
+                sign(listener.secret, body)):
+            self._respond(403, 'Bad signature')
+            return
+
+        try:
+            if self.headers.get('Content-Type', '').startswith(
+                    'application/x-www-form-urlencoded'):
+                body = urlparse.parse_qs(body)['payload'][0]
+            payload = json.loads(body)
+        except (KeyError, ValueError):
+            self._respond(400, 'Bad payload')
+            return
+        if not isinstance(payload, dict):
+            self._respond(400, 'Bad payload')
+            return
+        payload.setdefault('event', self.headers.get('X-ReviewBoard-Event'))
+        try:
+            # Whatever is queued has to apply cleanly.
+            review_request_change(payload)
+        except ValueError:
+            self._respond(400, 'Bad payload')
+            return
+
+        listener.events.put(payload)
+        self._respond(200, 'OK')
+
+    def _respond(self, code, message):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    def log_message(self, format, *args):
+        print "webhook: %s" % (format % args,)
+
@@ -0,0 +1,120 @@
+""" Working day and working hour arithmetic in constant time.
+
+    The counts are computed from whole weeks plus the few remaining days
+    instead of by enumerating the days, and holidays are counted with
+    a binary search, so the cost doesn't depend on how far apart the dates
+    are.
+"""
+
+import bisect
+import datetime
+
+from dateutil.tz import tzlocal
+
+WEEKEND = (5, 6) # Saturday, Sunday
+
+
+def parse_holidays(value):
+    """
+    Parses a comma or whitespace separated list of YYYY-MM-DD dates.
+    """
+    return [datetime.datetime.strptime(d, '%Y-%m-%d').date()
+            for d in value.replace(',', ' ').split()]
+
+
+class WorkCalendar(object):
+    """
+    Working days are the days outside @weekend which aren't in @holidays.
+    Working hours are the hours between @workday_start and @workday_end
+    (in local time) on working days.
+    """
+    def __init__(self, holidays=(), workday_start=0, workday_end=24,
+                 weekend=WEEKEND, tz=None):
+        self.weekend = frozenset(weekend)
+        # Holidays on weekend days don't change anything.
+        self.holidays = sorted(set(d for d in holidays
+                                   if d.weekday() not in self.weekend))
+        self._holiday_set = frozenset(self.holidays)
+        self.workday_start = workday_start
+        self.workday_end = workday_end
+        self.tz = tz or tzlocal()
+
+    def is_workday(self, day):
+        return (day.weekday() not in self.weekend and
+                day not in self._holiday_set)
+
+    def count_workdays(self, first, last):
+        """
+        Returns the number of working days between dates @first and @last
+        (both included).
+        """
+        if last < first:
+            return 0
+        days = (last - first).days + 1
+        weeks, rest = divmod(days, 7)
+        count = weeks * (7 - len(self.weekend))
+        weekday = first.weekday()
+        for i in range(rest):
+            if (weekday + i) % 7 not in self.weekend:
+                count += 1
+        count -= (bisect.bisect_right(self.holidays, last) -
+                  bisect.bisect_left(self.holidays, first))
+        return count
+
+    def work_days_diff(self, a, b):
+        """
+        Returns the number of working days from datetime @a to datetime @b,
+        i.e. the number of working days d for which the time of day of @a on
+        d falls between @a and @b (so @a's day counts, @b's day only if
+        @b's time of day isn't earlier than @a's).
+        """
+        a, b = self.localize(a), self.localize(b)
+        if b < a:
+            return 0
+        count = self.count_workdays(a.date(), b.date())
+        if b.time() < a.time() and self.is_workday(b.date()):
+            count -= 1
+        return count
+
+    def work_hours_between(self, a, b):
+        """
+        Returns the number of working hours (as a float) between datetimes
+        @a and @b.
+        """
+        a, b = self.localize(a), self.localize(b)
+        if b <= a:
+            return 0.0
+        if a.date() == b.date():
+            seconds = self._work_seconds(a.date(), a, b)
+        else:
+            hours_per_day = self.workday_end - self.workday_start
+            one_day = datetime.timedelta(days=1)
+            seconds = (self._work_seconds(a.date(), a, b) +
+                       self._work_seconds(b.date(), a, b) +
+                       3600 * hours_per_day * self.count_workdays(
+                           a.date() + one_day, b.date() - one_day))
+        return seconds / 3600.0
+
+    def _work_seconds(self, day, a, b):
+        """
+        Returns the number of working seconds on @day between @a and @b.
+        """
+        if not self.is_workday(day):
+            return 0
+        midnight = datetime.datetime.combine(day, datetime.time()).replace(
+            tzinfo=self.tz)
+        start = max(a, midnight + datetime.timedelta(hours=self.workday_start))
+        end = min(b, midnight + datetime.timedelta(hours=self.workday_end))
+        if end <= start:
+            return 0
+        delta = end - start
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+    def localize(self, dt):
+        """
+        Returns @dt in the calendar time zone (naive datetimes are assumed
+        to be in it already).
+        """
+        if dt.tzinfo is None:
+            return dt.replace(tzinfo=self.tz)
+        return dt.astimezone(self.tz)